@@ -6,7 +6,7 @@
 from trytond.pool import Pool
 from channel import (
     SaleChannel, ReadUser, WriteUser, ChannelException, ChannelOrderState,
-    TaxMapping
+    TaxMapping, ChannelInventoryChange, ChannelExceptionArchive
 )
 from wizard import (
     ImportDataWizard, ImportDataWizardStart, ImportDataWizardSuccess,
@@ -20,7 +20,14 @@ from product import (
 )
 from carrier import SaleChannelCarrier
 from sale import Sale, SaleLine
-from user import User
+from user import User, UserGroup
+from stock import StockMove
+from job import SaleChannelJob
+from checkpoint import ChannelCheckpoint
+from ratelimit import ChannelRateLimit, ChannelRateLimitLease
+from synclog import ChannelSyncLog
+from claim import ChannelOrderClaim
+from importwindow import ChannelImportWindow
 
 
 def register():
@@ -30,9 +37,11 @@ def register():
         ReadUser,
         WriteUser,
         ChannelException,
+        ChannelExceptionArchive,
         ChannelOrderState,
         SaleChannelCarrier,
         User,
+        UserGroup,
         Sale,
         SaleLine,
         ProductSaleChannelListing,
@@ -46,6 +55,15 @@ def register():
         ExportPricesStatus,
         ExportPricesStart,
         AddProductListingStart,
+        ChannelInventoryChange,
+        StockMove,
+        SaleChannelJob,
+        ChannelCheckpoint,
+        ChannelRateLimit,
+        ChannelRateLimitLease,
+        ChannelSyncLog,
+        ChannelOrderClaim,
+        ChannelImportWindow,
         module='sale_channel', type_='model'
     )
     Pool.register(
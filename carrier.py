@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from trytond.cache import Cache
 from trytond.pool import PoolMeta
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pyson import Eval
@@ -27,8 +28,59 @@ class SaleChannelCarrier(ModelSQL, ModelView):
     _rec_name = 'name'
 
     name = fields.Char('Name', states=CARRIER_STATES, depends=CARRIER_DEPENDS)
-    code = fields.Char("Code", states=CARRIER_STATES, depends=CARRIER_DEPENDS)
+    code = fields.Char(
+        "Code", select=True, states=CARRIER_STATES, depends=CARRIER_DEPENDS
+    )
     carrier = fields.Many2One('carrier', 'Carrier')
     channel = fields.Many2One(
-        'sale.channel', 'Channel', readonly=True
+        'sale.channel', 'Channel', readonly=True, select=True
     )
+
+    _index_cache = Cache('sale.channel.carrier.get_index', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(SaleChannelCarrier, cls).__setup__()
+        cls._error_messages.update({
+            'unique_code_per_channel':
+                'Shipping carrier code must be unique per channel',
+        })
+        cls._sql_constraints += [
+            ('unique_code_per_channel', 'UNIQUE(channel, code)',
+             'unique_code_per_channel'),
+        ]
+
+    @classmethod
+    def create(cls, vlist):
+        cls._index_cache.clear()
+        return super(SaleChannelCarrier, cls).create(vlist)
+
+    @classmethod
+    def write(cls, carriers, values, *args):
+        cls._index_cache.clear()
+        super(SaleChannelCarrier, cls).write(carriers, values, *args)
+
+    @classmethod
+    def delete(cls, carriers):
+        cls._index_cache.clear()
+        super(SaleChannelCarrier, cls).delete(carriers)
+
+    @classmethod
+    def get_index(cls, channel_id):
+        """
+        Return the shipping carriers of the channel as a dictionary of code
+        and the id of the tryton carrier mapped, or None if the carrier is
+        not mapped yet.
+
+        The index is cached until a shipping carrier is modified.
+
+        :param channel_id: ID of the channel
+        """
+        index = cls._index_cache.get(channel_id)
+        if index is None:
+            index = dict(
+                (carrier.code, carrier.carrier and carrier.carrier.id)
+                for carrier in cls.search([('channel', '=', channel_id)])
+            )
+            cls._index_cache.set(channel_id, index)
+        return index
@@ -3,19 +3,35 @@
     sale_channel.py
 
 """
-from datetime import datetime
-
+import Queue
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sql import Literal, Column, Cast, Null
+from sql.aggregate import Max
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp, Position, Substring
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 from trytond.pyson import Eval, Bool
 from trytond.model import ModelView, fields, ModelSQL
+from trytond.tools import grouped_slice
 from dateutil.relativedelta import relativedelta
 from trytond.modules.company.company import TIMEZONES
 
 __metaclass__ = PoolMeta
 __all__ = [
     'SaleChannel', 'ReadUser', 'WriteUser', 'ChannelException',
-    'ChannelOrderState', 'TaxMapping'
+    'ChannelOrderState', 'TaxMapping', 'ChannelInventoryChange',
+    'ChannelExceptionArchive'
 ]
 
 STATES = {
@@ -32,6 +48,18 @@ INVISIBLE_IF_MANUAL = {
     'invisible': Eval('source') == 'manual',
 }
 
+logger = logging.getLogger('sale_channel')
+
+# Fields of channels the cached sale defaults and allowed channels of users
+# are computed from
+SALE_DEFAULTS_FIELDS = frozenset([
+    'company', 'warehouse', 'currency', 'price_list', 'payment_term',
+    'invoice_method', 'shipment_method',
+])
+ALLOWED_CHANNELS_FIELDS = frozenset([
+    'active', 'company', 'read_users', 'create_users',
+])
+
 
 class SaleChannel(ModelSQL, ModelView):
     """
@@ -161,6 +189,36 @@ class SaleChannel(ModelSQL, ModelView):
     # This field is to set according to sequence
     sequence = fields.Integer('Sequence', select=True)
 
+    rate_limit = fields.Float(
+        'Rate Limit', states=INVISIBLE_IF_MANUAL, depends=['source'],
+        help='Maximum number of calls per second to the channel, '
+        'leave empty for no limit'
+    )
+    rate_limit_burst = fields.Integer(
+        'Rate Limit Burst', states=INVISIBLE_IF_MANUAL, depends=['source'],
+        help='Number of calls which can be made at once before the rate '
+        'limit applies'
+    )
+    rate_limit_concurrency = fields.Integer(
+        'Rate Limit Concurrency', states=INVISIBLE_IF_MANUAL,
+        depends=['source'],
+        help='Maximum number of calls running at the same time, '
+        'leave empty for no limit'
+    )
+
+    shard_order_import = fields.Boolean(
+        'Import Orders In Windows', help='Import the orders since the last '
+        'import in windows of time run in parallel by the channel jobs'
+    )
+    defer_shipment_assignment = fields.Boolean(
+        'Defer Shipment Assignment', help='Assign the shipments of imported '
+        'orders later in batches instead of during the import'
+    )
+
+    _sale_defaults_cache = Cache(
+        'sale.channel.get_sale_defaults', context=False
+    )
+
     @staticmethod
     def default_timezone():
         return 'UTC'
@@ -169,6 +227,10 @@ class SaleChannel(ModelSQL, ModelView):
     def default_sequence():
         return 10
 
+    @staticmethod
+    def default_rate_limit_burst():
+        return 1
+
     def get_last_order_import_time_required(self, name):
         """
         Returns True or False if last_order_import_time field should be required
@@ -193,6 +255,8 @@ class SaleChannel(ModelSQL, ModelView):
                 "Shipping carrier is not configured for code: %s",
             "no_tax_found":
                 "%s (tax) of rate %f was not found.",
+            "no_taxes_found":
+                "The following taxes were not found:\n%s",
             "no_order_states_to_import":
                 "No importable order state found\n"
                 "HINT: Import order states from Order States tab in Channel"
@@ -243,6 +307,73 @@ class SaleChannel(ModelSQL, ModelView):
             company = Company(SaleChannel.default_company())  # pragma: nocover
         return company and company.party.id or None
 
+    @classmethod
+    def create(cls, vlist):
+        # Ids of channels created by rolled back transactions are reused
+        cls._sale_defaults_cache.clear()
+        Pool().get('res.user').clear_allowed_channels_cache()
+        return super(SaleChannel, cls).create(vlist)
+
+    @classmethod
+    def write(cls, channels, values, *args):
+        """
+        Clear the cached sale defaults and allowed channels of users only
+        when the fields they are computed from are written, so that the
+        crons saving the time of their last run do not clear them.
+        """
+        names = set()
+        actions = iter((channels, values) + args)
+        for _, vals in zip(actions, actions):
+            names.update(vals.keys())
+        if names & SALE_DEFAULTS_FIELDS:
+            cls._sale_defaults_cache.clear()
+        if names & ALLOWED_CHANNELS_FIELDS:
+            Pool().get('res.user').clear_allowed_channels_cache()
+        super(SaleChannel, cls).write(channels, values, *args)
+
+    @classmethod
+    def delete(cls, channels):
+        cls._sale_defaults_cache.clear()
+        Pool().get('res.user').clear_allowed_channels_cache()
+        super(SaleChannel, cls).delete(channels)
+
+    def rate_limited(self):
+        """
+        Return a context manager to wrap each call made to the channel, so
+        that the calls made by all the workers respect the rate limit of the
+        channel::
+
+            with channel.rate_limited():
+                client.update_inventory(...)
+        """
+        RateLimit = Pool().get('sale.channel.rate_limit')
+
+        return RateLimit.limit(self)
+
+    @classmethod
+    def get_sale_defaults(cls, channel_id):
+        """
+        Return the default values of a sale in the channel. The values are
+        read once and cached until a channel is modified.
+
+        :param channel_id: ID of the channel
+        :return: Dictionary of field names and values
+        """
+        defaults = cls._sale_defaults_cache.get(channel_id)
+        if defaults is None:
+            channel = cls(channel_id)
+            defaults = {
+                'company': channel.company.id,
+                'warehouse': channel.warehouse.id,
+                'currency': channel.currency.id,
+                'price_list': channel.price_list.id,
+                'payment_term': channel.payment_term.id,
+                'invoice_method': channel.invoice_method,
+                'shipment_method': channel.shipment_method,
+            }
+            cls._sale_defaults_cache.set(channel_id, defaults)
+        return defaults.copy()
+
     @classmethod
     def get_current_channel(cls):
         """Helper method to get the current current_channel.
@@ -269,22 +400,35 @@ class SaleChannel(ModelSQL, ModelView):
         Search for an existing carrier by matching code and channel.
         If found, return its active record else raise_user_error.
         """
-        SaleCarrierChannel = Pool().get('sale.channel.carrier')
+        carrier, = self.get_shipping_carriers([code], silent=silent)
+        return carrier
 
-        try:
-            carrier, = SaleCarrierChannel.search([
-                ('code', '=', code),
-                ('channel', '=', self.id),
-            ])
-        except ValueError:
-            if silent:
-                return None
+    def get_shipping_carriers(self, codes, silent=False):
+        """
+        Find the tryton carriers of the given shipping carrier codes of the
+        channel with a single lookup in the cached carrier index.
+
+        :param codes: List of codes of shipping carriers on the channel
+        :param silent: If True, None is returned for the codes not found
+                       instead of raising a user error for all of them
+        :return: List of active records of carriers in the same order
+        """
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        SaleCarrierChannel = pool.get('sale.channel.carrier')
+
+        index = SaleCarrierChannel.get_index(self.id)
+
+        missing = [code for code in codes if code not in index]
+        if missing and not silent:
             self.raise_user_error(
                 'no_carriers_found',
-                error_args=code
+                error_args=', '.join(missing)
             )
-        else:
-            return carrier.carrier
+        return [
+            Carrier(index[code]) if index.get(code) else None
+            for code in codes
+        ]
 
     def get_order_states_to_import(self):
         """
@@ -296,10 +440,12 @@ class SaleChannel(ModelSQL, ModelView):
         if Transaction().context.get('include_past_orders', False):
             order_states_to_import.append('import_as_past')
 
-        order_states = OrderState.search([
-            ('action', 'in', order_states_to_import),
-            ('channel', '=', self.id),
-        ])
+        order_states = OrderState.browse(sorted(
+            order_state['id']
+            for code_states in OrderState.get_map(self.id).itervalues()
+            for order_state in code_states
+            if order_state['action'] in order_states_to_import
+        ))
         if not order_states:
             self.raise_user_error("no_order_states_to_import")
         return order_states
@@ -333,6 +479,90 @@ class SaleChannel(ModelSQL, ModelView):
             % self.source
         )
 
+    @classmethod
+    def run_for_channels(cls, method_name, channels=None):
+        """
+        Call the method on each channel, each one in its own transaction and
+        in the context of the company of the channel.
+
+        Channels are run in parallel by a bounded pool of worker threads, so
+        a slow channel does not hold back the others and a failing channel
+        does not roll back the others. The pool is configured in the
+        `sale_channel` section of the trytond configuration:
+
+            workers: Number of channels run at the same time (default 4)
+            timeout: Seconds after which a channel is no longer waited for
+                     and reported as timed out (default no timeout)
+
+        On SQLite or with a single worker the channels are run one after the
+        other.
+
+        :param method_name: Name of the method to call on the channels
+        :param channels: List of active records of channels, all the channels
+                         if not given
+        :return: Dictionary of channel id and a tuple of the status (`done`,
+                 `not_implemented`, `failed` or `timeout`) and a message
+        """
+        SyncLog = Pool().get('sale.channel.sync_log')
+
+        if channels is None:
+            channels = cls.search([])
+        channel_ids = map(int, channels)
+
+        workers = config.getint('sale_channel', 'workers', default=4)
+        timeout = config.getfloat('sale_channel', 'timeout', default=None)
+
+        if workers <= 1 or backend.name() == 'sqlite':
+            results = {}
+            for channel_id in channel_ids:
+                stats = {}
+                with Transaction().new_cursor() as txn:
+                    results[channel_id] = cls.run_for_channel(
+                        channel_id, method_name, stats
+                    )
+                    if results[channel_id][0] == 'failed':
+                        txn.cursor.rollback()
+                    else:
+                        txn.cursor.commit()
+                # Channels which do not implement the method are not logged
+                if results[channel_id][0] != 'not_implemented':
+                    SyncLog.log(
+                        channel_id, method_name, results[channel_id], stats
+                    )
+            return results
+        return ChannelWorkerPool(workers, timeout).run(
+            cls, channel_ids, method_name
+        )
+
+    @classmethod
+    def run_for_channel(cls, channel_id, method_name, stats=None):
+        """
+        Call the method on the channel in the current transaction and the
+        context of the company of the channel.
+
+        :param stats: Optional dictionary filled with the statistics of the
+                      run, see `sale.channel.sync_log`
+        :return: Tuple of the status and a message, see `run_for_channels`
+        """
+        SyncLog = Pool().get('sale.channel.sync_log')
+
+        channel = cls(channel_id)
+        with Transaction().set_context(company=channel.company.id), \
+                SyncLog.measure(stats) as stats:
+            try:
+                stats['records'] = SyncLog.count_records(
+                    getattr(channel, method_name)()
+                )
+            except NotImplementedError:
+                # Silently pass if method is not implemented
+                return ('not_implemented', '')
+            except Exception, exc:
+                logger.exception(
+                    'Channel %s failed to run %s', channel.id, method_name
+                )
+                return ('failed', unicode(exc))
+        return ('done', '')
+
     @classmethod
     def import_orders_using_cron(cls):  # pragma: nocover
         """
@@ -341,14 +571,23 @@ class SaleChannel(ModelSQL, ModelView):
         Downstream module need not to implement this method.
         It will automatically call import_orders of the channel
         Silently pass if import_orders is not implemented
+
+        Channels importing orders in windows are planned by
+        `plan_order_import_using_cron` instead.
         """
-        for channel in cls.search([]):
-            with Transaction().set_context(company=channel.company.id):
-                try:
-                    channel.import_orders()
-                except NotImplementedError:
-                    # Silently pass if method is not implemented
-                    pass
+        cls.run_for_channels('import_orders', cls.search([
+            ('shard_order_import', '=', False),
+        ]))
+
+    @classmethod
+    def plan_order_import_using_cron(cls):  # pragma: nocover
+        """
+        Cron method to plan the import of orders in windows for the channels
+        importing orders in windows
+        """
+        cls.run_for_channels('plan_order_import', cls.search([
+            ('shard_order_import', '=', True),
+        ]))
 
     @classmethod
     def export_product_prices_using_cron(cls):  # pragma: nocover
@@ -359,75 +598,217 @@ class SaleChannel(ModelSQL, ModelView):
         It will automatically call export_product_prices method of the channel.
         Silently pass if export_product_prices is not implemented
         """
-        for channel in cls.search([]):
-            with Transaction().set_context(company=channel.company.id):
-                try:
-                    channel.export_product_prices()
-                except NotImplementedError:
-                    # Silently pass if method is not implemented
-                    pass
+        cls.run_for_channels('export_product_prices')
 
     def get_listings_to_export_inventory(self):
         """
         This method returns listing, which needs inventory update
 
+        Listings are picked up from the inventory change log
+        (`sale.channel.inventory_change`) which is fed whenever stock moves or
+        listings are created or updated. When the context key
+        `inventory_delta_fallback` is set, listings are instead looked up
+        from the stock moves updated after the last inventory export.
+
         Downstream module can override change its implementation
 
         :return: List of AR of `product.product.channel_listing`
         """
         ChannelListing = Pool().get('product.product.channel_listing')
-        cursor = Transaction().cursor
+
+        if Transaction().context.get('inventory_delta_fallback') and \
+                self.last_inventory_export_time:
+            return self.get_listings_updated_since(
+                self.last_inventory_export_time
+            )
+
+        return ChannelListing.browse(
+            self.get_listing_ids_to_export_inventory()
+        )
+
+    # Tells whether get_listings_to_export_inventory is overridden by a
+    # downstream module
+    _default_get_listings_to_export_inventory = \
+        get_listings_to_export_inventory
+
+    def get_listing_ids_to_export_inventory(self, after=None, limit=None):
+        """
+        Return a page of the sorted ids of the listings which need inventory
+        update, read from the inventory change log or, before the first
+        inventory export, from all the active listings.
+
+        :param after: If given, only the ids greater than it are returned
+        :param limit: If given, the maximum number of ids returned
+        :return: List of ids of `product.product.channel_listing`
+        """
+        ChannelListing = Pool().get('product.product.channel_listing')
+        InventoryChange = Pool().get('sale.channel.inventory_change')
 
         if not self.last_inventory_export_time:
-            # Return all active listings
-            return ChannelListing.search([
+            # All active listings
+            domain = [
                 ('channel', '=', self),
-                ('state', '=', 'active')
-            ])
-        else:
-            # Query to find listings
-            #   in which product inventory is recently updated or
-            #   listing it self got updated recently
-            cursor.execute("""
-                SELECT listing.id
-                FROM product_product_channel_listing AS listing
-                INNER JOIN stock_move ON stock_move.product = listing.product
-                WHERE listing.channel = %s AND listing.state = 'active' AND
-                (
-                    COALESCE(stock_move.write_date, stock_move.create_date) > %s
-                    OR
-                    COALESCE(listing.write_date, listing.create_date) > %s
-                )
-                GROUP BY listing.id
-            """, (
-                self.id,
-                self.last_inventory_export_time,
-                self.last_inventory_export_time,
+                ('state', '=', 'active'),
+            ]
+            if after is not None:
+                domain.append(('id', '>', after))
+            return map(int, ChannelListing.search(
+                domain, order=[('id', 'ASC')], limit=limit
             ))
-            listing_ids = map(lambda r: r[0], cursor.fetchall())
-            return ChannelListing.browse(listing_ids)
+
+        return InventoryChange.get_changed_listings(
+            self, Transaction().context.get('last_inventory_change'),
+            after=after, limit=limit
+        )
+
+    def iter_listing_ids_to_export_inventory(self, after=None):
+        """
+        Yield the sorted ids of the listings which need inventory update in
+        pages of `inventory_export_chunk_size` ids (`sale_channel` section of
+        the trytond configuration, default 500). The pages are read one at a
+        time, unless `get_listings_to_export_inventory` is overridden or the
+        context key `inventory_delta_fallback` is set, in which case the
+        listings it returns are split in pages.
+
+        :param after: If given, only the ids greater than it are yielded
+        :return: Generator of lists of ids of listings
+        """
+        Checkpoint = Pool().get('sale.channel.checkpoint')
+
+        page_size = config.getint(
+            'sale_channel', 'inventory_export_chunk_size', default=500
+        )
+        if self.get_listings_to_export_inventory.im_func is not \
+                self._default_get_listings_to_export_inventory.im_func or \
+                Transaction().context.get('inventory_delta_fallback'):
+            listing_ids = Checkpoint.get_remaining_ids(
+                map(int, self.get_listings_to_export_inventory()),
+                {'position': after}
+            )
+            for sub_ids in grouped_slice(listing_ids, page_size):
+                yield list(sub_ids)
+            return
+
+        while True:
+            listing_ids = self.get_listing_ids_to_export_inventory(
+                after=after, limit=page_size
+            )
+            if listing_ids:
+                yield listing_ids
+            if len(listing_ids) < page_size:
+                return
+            after = listing_ids[-1]
+
+    def get_listings_updated_since(self, since):
+        """
+        Return the active listings of this channel in which product inventory
+        or the listing itself got updated after the given time.
+
+        Each predicate is a separate subquery on an indexed column, so this
+        stays cheap even with a large stock move history. It is used as a
+        fallback when the inventory change log cannot be trusted, for example
+        when stock moves were written with raw SQL.
+
+        :param since: datetime after which updates must be considered
+        :return: List of AR of `product.product.channel_listing`
+        """
+        ChannelListing = Pool().get('product.product.channel_listing')
+        StockMove = Pool().get('stock.move')
+        cursor = Transaction().cursor
+
+        listing = ChannelListing.__table__()
+        move = StockMove.__table__()
+
+        cursor.execute(*listing.select(
+            listing.id,
+            where=(listing.channel == self.id) &
+            (listing.state == 'active') & (
+                listing.product.in_(
+                    move.select(move.product, where=move.create_date > since)
+                ) |
+                listing.product.in_(
+                    move.select(move.product, where=move.write_date > since)
+                ) |
+                (listing.create_date > since) |
+                (listing.write_date > since)
+            )
+        ))
+        listing_ids = map(lambda r: r[0], cursor.fetchall())
+        return ChannelListing.browse(listing_ids)
 
     def export_inventory(self):
         """
         Export inventory to external channel
+
+        Listings are exported in chunks. The changes of the inventory change
+        log of the listings of a chunk are read along with their export and,
+        after each chunk, they are deleted, the snapshot of the
+        availabilities exported is saved and the progress is checkpointed in
+        `sale.channel.checkpoint`, in a separate transaction. Only the
+        changes actually read are deleted, so changes committed meanwhile by
+        concurrent transactions are exported by the next run, and an
+        interrupted export resumes after the last exported chunk.
         """
         Listing = Pool().get('product.product.channel_listing')
         Channel = Pool().get('sale.channel')
+        InventoryChange = Pool().get('sale.channel.inventory_change')
+        Checkpoint = Pool().get('sale.channel.checkpoint')
+        Job = Pool().get('sale.channel.job')
 
-        last_inventory_export_time = datetime.utcnow()
         channel_id = self.id
 
-        listings = self.get_listings_to_export_inventory()
-        # TODO: check if inventory export is allowed for this channel
-        Listing.export_bulk_inventory(listings)
+        # Changes logged after this point are left for the next export
+        checkpoint = Checkpoint.start(
+            self, 'inventory', watermark=InventoryChange.get_last_change(self)
+        )
+        last_change = checkpoint['watermark']
+
+        with Transaction().set_context(last_inventory_change=last_change):
+            pages = self.iter_listing_ids_to_export_inventory(
+                after=checkpoint['position']
+            )
+
+            # TODO: check if inventory export is allowed for this channel
+            processed = 0
+            for page in pages:
+                for chunk, availabilities in \
+                        Listing.iter_export_chunks(page):
+                    sub_ids = map(int, chunk)
+                    changes = InventoryChange.get_changes(
+                        self, last_change, listing_ids=sub_ids
+                    )
+                    exported = Listing.export_changed_inventory(
+                        chunk, availabilities
+                    )
+
+                    with Transaction().new_cursor() as txn:
+                        Listing.save_exported_availabilities(
+                            exported, availabilities
+                        )
+                        InventoryChange.delete_changes(
+                            sum(changes.itervalues(), [])
+                        )
+                        Checkpoint.save_position(
+                            checkpoint['id'], sub_ids[-1]
+                        )
+                        txn.cursor.commit()
+
+                    processed += len(sub_ids)
+                    Job.report_progress(processed)
 
         # XXX: Exporting inventory to external channel is an expensive.
         # To avoid lock on sale_channel table save record after
         # exporting all inventory
+        # Changes of listings which are not active are never exported
+        inactive_changes = InventoryChange.get_inactive_changes(
+            self, last_change
+        )
         with Transaction().new_cursor() as txn:
             channel = Channel(channel_id)
-            channel.last_inventory_export_time = last_inventory_export_time
+            channel.last_inventory_export_time = checkpoint['started_at']
             channel.save()
+            InventoryChange.delete_changes(inactive_changes)
+            Checkpoint.delete([Checkpoint(checkpoint['id'])])
             txn.cursor.commit()
 
     @classmethod
@@ -435,13 +816,7 @@ class SaleChannel(ModelSQL, ModelView):
         """
         Cron method to export inventory to external channel
         """
-        for channel in cls.search([]):
-            with Transaction().set_context(company=channel.company.id):
-                try:
-                    channel.export_inventory()
-                except NotImplementedError:
-                    # Silently pass if method is not implemented
-                    pass
+        cls.run_for_channels('export_inventory')
 
     def import_orders(self):
         """
@@ -457,6 +832,105 @@ class SaleChannel(ModelSQL, ModelView):
             "Import orders is not implemented for %s channels" % self.source
         )
 
+    def plan_order_import(self):
+        """
+        Plan the import of the orders since the last order import in windows
+        of `order_import_window` seconds (`sale_channel` section of the
+        trytond configuration, default 3600). A channel job is queued for
+        each window, so that the windows are imported in parallel by the job
+        workers.
+
+        The last order import time is first moved to the end of the windows
+        done or failed without gap since the last planning, and the new
+        windows start after the last window planned. The windows done are
+        deleted, the failed ones are kept until their job is retried and done.
+
+        :return: List of active records of the windows planned
+        """
+        ImportWindow = Pool().get('sale.channel.import_window')
+        Job = Pool().get('sale.channel.job')
+
+        windows = ImportWindow.search([('channel', '=', self.id)])
+        done = ImportWindow.get_done_prefix(windows)
+        if done:
+            self.last_order_import_time = max(
+                self.last_order_import_time or done[-1].end, done[-1].end
+            )
+            self.save()
+            ImportWindow.delete([w for w in done if w.state == 'done'])
+            windows = windows[len(done):]
+
+        if windows:
+            start = windows[-1].end
+        else:
+            start = self.last_order_import_time or \
+                self.default_last_order_import_time()
+        size = config.getint(
+            'sale_channel', 'order_import_window', default=3600
+        )
+        new_windows = ImportWindow.create([{
+            'channel': self.id,
+            'start': window_start,
+            'end': window_end,
+        } for window_start, window_end in ImportWindow.split(
+            start, datetime.utcnow(), size
+        )])
+        for window in new_windows:
+            window.job = Job.enqueue(
+                self, 'import_order_window', str(window.id)
+            )
+            window.save()
+        return new_windows
+
+    def import_order_window(self, window_id):
+        """
+        Import the orders of a window planned by `plan_order_import` and
+        mark it as done
+
+        When orders of the window were skipped because another transaction
+        claimed them, the window is left pending and a new job imports it
+        again after `job_retry_delay` seconds (`sale_channel` section of the
+        trytond configuration, default 60), in case that transaction fails.
+
+        :param window_id: ID of the window as a string, the argument of the
+                          job importing the window
+        :return: List of active records of sale orders imported
+        """
+        ImportWindow = Pool().get('sale.channel.import_window')
+        Job = Pool().get('sale.channel.job')
+
+        window = ImportWindow(int(window_id))
+        sales = self.import_orders_between(window.start, window.end)
+        if None in sales:
+            delay = config.getint(
+                'sale_channel', 'job_retry_delay', default=60
+            )
+            window.job = Job.enqueue(
+                self, 'import_order_window', window_id, delay=delay
+            )
+        else:
+            window.state = 'done'
+        window.save()
+        return [sale for sale in sales if sale is not None]
+
+    def import_orders_between(self, start, end):
+        """
+        Import the orders of the external channel created or updated from
+        start to end, both in UTC. Used by `import_order_window`.
+
+        Since external channels are implemented by downstream modules, it is
+        the responsibility of those channels to implement it, typically with
+        `import_orders_bulk`.
+
+        :return: List of active records of sale orders imported, None for the
+                 orders skipped because another transaction claimed them, as
+                 returned by `import_orders_bulk`
+        """
+        raise NotImplementedError(
+            "Import orders between dates is not implemented for %s channels"
+            % self.source
+        )
+
     def import_order(self, order_info):
         """
         Import specific order from external channel based on order_info.
@@ -474,6 +948,118 @@ class SaleChannel(ModelSQL, ModelView):
             "Import order is not implemented for %s channels" % self.source
         )
 
+    def import_orders_bulk(self, order_infos):
+        """
+        Import a batch of orders from external channel.
+
+        Orders whose channel identifier is already used by a sale are not
+        imported again, whatever the channel of the sale since channel
+        identifiers are unique across channels. The orders to import are
+        claimed with `sale.channel.order_claim` first, until the end of the
+        transaction, so that concurrent imports do not import them twice.
+        All the sales are created at once and then processed to their channel
+        state grouped by the tryton action.
+
+        Downstream modules must implement `get_order_identifier`,
+        `get_sale_values` and `get_order_state` for this to work.
+
+        :param order_infos: List of order_info, see `import_order`
+        :return: List of active records of sale orders in the same order as
+                 order_infos, None for the orders claimed or imported
+                 meanwhile by another transaction
+        """
+        Sale = Pool().get('sale.sale')
+        OrderClaim = Pool().get('sale.channel.order_claim')
+
+        identifiers = map(self.get_order_identifier, order_infos)
+
+        sale_by_identifier = {}
+        # Sales of channels the user can not read use identifiers too
+        with Transaction().set_user(0):
+            for sub_identifiers in grouped_slice(list(set(identifiers))):
+                for sale in Sale.search([
+                    ('channel_identifier', 'in', list(sub_identifiers)),
+                ]):
+                    sale_by_identifier[sale.channel_identifier] = sale
+
+        # Orders imported meanwhile by concurrent workers are left to them
+        claimed = set(OrderClaim.claim([
+            i for i in set(identifiers) if i not in sale_by_identifier
+        ]))
+
+        to_import = []
+        for identifier, order_info in zip(identifiers, order_infos):
+            if identifier in sale_by_identifier:
+                continue
+            # Mark as seen to skip duplicates within the batch
+            sale_by_identifier[identifier] = None
+            if identifier in claimed:
+                to_import.append((identifier, order_info))
+
+        vlist = []
+        for identifier, order_info in to_import:
+            values = self.get_sale_values(order_info)
+            values.setdefault('channel', self.id)
+            values['channel_identifier'] = identifier
+            vlist.append(values)
+        sales = Sale.create(vlist) if vlist else []
+
+        Sale.process_to_channel_states([
+            (sale, self.get_order_state(order_info))
+            for sale, (_, order_info) in zip(sales, to_import)
+        ])
+
+        for sale in sales:
+            sale_by_identifier[sale.channel_identifier] = sale
+        return [sale_by_identifier[i] for i in identifiers]
+
+    def get_order_identifier(self, order_info):
+        """
+        Return the channel identifier of the order from order_info. Used by
+        `import_orders_bulk`.
+
+        Since external channels are implemented by downstream modules, it is
+        the responsibility of those channels to implement it.
+
+        :param order_info: See `import_order`
+        """
+        raise NotImplementedError(
+            "Method get_order_identifier is not implemented for %s channel "
+            "yet" % self.source
+        )
+
+    def get_sale_values(self, order_info):
+        """
+        Return the values to create the sale order from order_info, including
+        the lines to create. The `channel_identifier` is set from
+        `get_order_identifier`. Used by `import_orders_bulk`.
+
+        Since external channels are implemented by downstream modules, it is
+        the responsibility of those channels to implement it.
+
+        :param order_info: See `import_order`
+        :return: Dictionary of values for `sale.sale` create
+        """
+        raise NotImplementedError(
+            "Method get_sale_values is not implemented for %s channel yet"
+            % self.source
+        )
+
+    def get_order_state(self, order_info):
+        """
+        Return the code of the state of the order on external channel from
+        order_info. Used by `import_orders_bulk`.
+
+        Since external channels are implemented by downstream modules, it is
+        the responsibility of those channels to implement it.
+
+        :param order_info: See `import_order`
+        """
+        raise NotImplementedError(
+            "Method get_order_state is not implemented for %s channel yet"
+            % self.source
+        )
+
     def import_products(self):
         """
         Import Products from external channel.
@@ -576,10 +1162,7 @@ class SaleChannel(ModelSQL, ModelView):
         ChannelOrderState = Pool().get('sale.channel.order_state')
 
         try:
-            order_state, = ChannelOrderState.search([
-                ('channel', '=', self.id),
-                ('code', '=', code),
-            ])
+            order_state, = ChannelOrderState.get_map(self.id).get(code, [])
         except ValueError:
             return {
                 'action': 'do_not_import',
@@ -588,9 +1171,9 @@ class SaleChannel(ModelSQL, ModelView):
             }
         else:
             return {
-                'action': order_state.action,
-                'invoice_method': order_state.invoice_method,
-                'shipment_method': order_state.shipment_method,
+                'action': order_state['action'],
+                'invoice_method': order_state['invoice_method'],
+                'shipment_method': order_state['shipment_method'],
             }
 
     def create_order_state(self, code, name):
@@ -604,13 +1187,10 @@ class SaleChannel(ModelSQL, ModelView):
         """
         OrderState = Pool().get('sale.channel.order_state')
 
-        order_states = OrderState.search([
-            ('code', '=', code),
-            ('channel', '=', self.id)
-        ])
+        order_states = OrderState.get_map(self.id).get(code)
 
         if order_states:
-            return order_states[0]
+            return OrderState(order_states[0]['id'])
 
         values = self.get_default_tryton_action(code, name)
         values.update({
@@ -665,6 +1245,68 @@ class SaleChannel(ModelSQL, ModelView):
 
         return rv
 
+    # Tells whether get_availability is overridden by a downstream module
+    _default_get_availability = get_availability
+
+    def get_availabilities(self, products):
+        """
+        Return availability of the products within the context of this
+        channel.
+
+        When a downstream module overrides `get_availability`, it is called
+        for each product. Otherwise stock quantities are computed in bulk for
+        all the products and the availabilities of listings are read with
+        `get_availabilities` of listings.
+
+        :param products: List of active records of products
+        :return: Dictionary of product id and its availability
+        """
+        Listing = Pool().get('product.product.channel_listing')
+        Product = Pool().get('product.product')
+
+        if self.get_availability.im_func is not \
+                self._default_get_availability.im_func:
+            return dict(
+                (product.id, self.get_availability(product))
+                for product in products
+            )
+
+        res = {}
+        listings = Listing.search([
+            ('channel', '=', self.id),
+            ('product', 'in', map(int, products)),
+        ], order=[('id', 'ASC')])
+        listing_by_product = {}
+        for listing in listings:
+            listing_by_product.setdefault(listing.product.id, listing)
+        if listing_by_product:
+            # If there are listings, return the values from listing since
+            # they override channel defaults for a product and channel
+            availabilities = Listing.get_availabilities(
+                listing_by_product.values()
+            )
+            for product_id, listing in listing_by_product.iteritems():
+                res[product_id] = availabilities[listing.id]
+
+        product_ids = [
+            p.id for p in products if p.id not in listing_by_product
+        ]
+        if not product_ids:
+            return res
+
+        with Transaction().set_context(**self.get_availability_context()):
+            quantities = Product.get_quantity(
+                Product.browse(product_ids), 'quantity'
+            )
+        for product_id in product_ids:
+            rv = {'type': 'bucket'}
+            if quantities[product_id] > 0:
+                rv['value'] = 'in_stock'
+            else:
+                rv['value'] = 'out_of_stock'
+            res[product_id] = rv
+        return res
+
     @classmethod
     def update_order_status_using_cron(cls):  # pragma: nocover
         """
@@ -674,13 +1316,7 @@ class SaleChannel(ModelSQL, ModelView):
         It will automatically call update_order_status of the channel
         Silently pass if update_order_status is not implemented
         """
-        for channel in cls.search([]):
-            with Transaction().set_context(company=channel.company.id):
-                try:
-                    channel.update_order_status()
-                except NotImplementedError:
-                    # Silently pass if method is not implemented
-                    pass
+        cls.run_for_channels('update_order_status')
 
     def update_order_status(self):
         """This method is responsible for updating order status from external
@@ -698,25 +1334,186 @@ class SaleChannel(ModelSQL, ModelView):
         Search for an existing Tax record by matching name and rate.
         If found return its active record else raise user error.
         """
-        TaxMapping = Pool().get('sale.channel.tax')
-        domain = [
-            ('rate', '=', rate),
-            ('channel', '=', self)
-        ]
-        if name:
-            # Search with name when it is provided
-            # Name can be explicitly passed as None, when external
-            # channels like magento does not provide it.
-            domain.append(('name', '=', name))
+        tax, = self.get_taxes([(name, rate)])
+        return tax
 
-        try:
-            mapped_tax, = TaxMapping.search(domain)
-        except ValueError:
-            self.raise_user_error(
-                'no_tax_found', error_args=(name, rate)
+    def get_taxes(self, taxes):
+        """
+        Find the Tax records mapped to the given names and rates in one pass
+        over the cached tax mappings of the channel. A tax matching only by
+        rate is looked up when its name is not provided, since external
+        channels like magento do not provide it.
+
+        All the taxes which are not found are reported together in a single
+        user error.
+
+        :param taxes: List of tuples of name and rate
+        :return: List of active records of taxes in the same order
+        """
+        pool = Pool()
+        Tax = pool.get('account.tax')
+        TaxMapping = pool.get('sale.channel.tax')
+
+        index = TaxMapping.get_index(self.id)
+
+        tax_ids, missing = [], []
+        for name, rate in taxes:
+            try:
+                tax_id, = index.get(TaxMapping.index_key(name, rate), [])
+            except ValueError:
+                missing.append((name, rate))
+            else:
+                tax_ids.append(tax_id)
+
+        if len(missing) == 1:
+            self.raise_user_error('no_tax_found', error_args=missing[0])
+        elif missing:
+            self.raise_user_error('no_taxes_found', error_args=(
+                '\n'.join(
+                    self.raise_user_error(
+                        'no_tax_found', error_args=tax, raise_exception=False
+                    ) for tax in missing
+                ),
+            ))
+        return Tax.browse(tax_ids)
+
+
+class ChannelWorkerPool(object):
+    """
+    A pool of a fixed number of worker threads running a method of sale
+    channels, each channel in its own transaction.
+
+    The workers take the channels from a queue, so no more than `workers`
+    transactions run at the same time. A channel running longer than the
+    timeout is reported as timed out and no longer waited for, but the
+    thread running it can not be stopped and its worker stays busy until
+    its transaction finishes. When every worker is busy with a timed out
+    channel, the channels not started yet are reported as timed out too.
+    """
+
+    def __init__(self, workers, timeout=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.started = {}
+        self.results = {}
+
+    def run(self, Channel, channel_ids, method_name):
+        """
+        Run the method for the channels and wait for all of them to finish
+        or time out.
+
+        :return: Dictionary of channel id and result of `run_for_channel`
+        """
+        transaction = Transaction()
+        args = (
+            transaction.cursor.database_name, transaction.user,
+            transaction.context.copy(), Channel, method_name,
+        )
+        return self.map(
+            lambda channel_id: self.work(channel_id, *args), channel_ids,
+            'Channel %%s running %s' % method_name
+        )
+
+    def map(self, function, keys, description='%s'):
+        """
+        Call the function with each key in the worker threads and wait for
+        all the calls to finish or time out.
+
+        :param function: Function called with a key, returning a tuple of
+                         the status and a message
+        :param keys: List of keys
+        :param description: Description of a call in the logs, formatted with
+                            its key
+        :return: Dictionary of key and result of the function
+        """
+        tasks = Queue.Queue()
+        for key in keys:
+            tasks.put(key)
+        threads = []
+        for _ in xrange(min(self.workers, len(keys))):
+            thread = threading.Thread(
+                target=self.worker, args=(tasks, function)
             )
-        else:
-            return mapped_tax.tax
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        while True:
+            with self.lock:
+                for key in self.started:
+                    self.check_timeout(key, description)
+                pending = [k for k in keys if k not in self.results]
+                if not pending:
+                    return self.results
+                if len(self.started) == len(threads) and all(
+                        k in self.results for k in self.started):
+                    # All the workers are stuck, the others never start
+                    for key in pending:
+                        logger.warning('%s not started', description % key)
+                        self.results[key] = (
+                            'timeout', 'Not started, all the workers are '
+                            'busy with timed out runs'
+                        )
+                    return self.results
+            time.sleep(0.1)
+
+    def worker(self, tasks, function):
+        """
+        Call the function with the keys taken from the queue until it is
+        empty
+        """
+        while True:
+            try:
+                key = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            with self.lock:
+                if key in self.results:
+                    continue
+                self.started[key] = time.time()
+            try:
+                result = function(key)
+            except Exception, exc:
+                result = ('failed', unicode(exc))
+            with self.lock:
+                # The worker is free only once the call is finished
+                del self.started[key]
+                self.results.setdefault(key, result)
+
+    def check_timeout(self, key, description):
+        """
+        Report the call as timed out if it is running for too long.
+        Must be called with the lock held.
+        """
+        if not self.timeout or key in self.results:
+            return
+        if time.time() - self.started[key] <= self.timeout:
+            return
+        logger.warning('%s timed out', description % key)
+        self.results[key] = (
+            'timeout', 'Timed out after %s seconds' % self.timeout
+        )
+
+    @staticmethod
+    def work(channel_id, database_name, user, context, Channel, method_name):
+        """
+        Run the method for a channel in a new transaction
+        """
+        with Transaction().start(
+                database_name, user, context=context) as txn:
+            stats = {}
+            result = Channel.run_for_channel(channel_id, method_name, stats)
+            if result[0] == 'failed':
+                txn.cursor.rollback()
+            else:
+                txn.cursor.commit()
+            if result[0] != 'not_implemented':
+                Pool().get('sale.channel.sync_log').log(
+                    channel_id, method_name, result, stats
+                )
+            Cache.resets(database_name)
+        return result
 
 
 class ReadUser(ModelSQL):
@@ -733,6 +1530,21 @@ class ReadUser(ModelSQL):
         'res.user', 'User', ondelete='RESTRICT', required=True
     )
 
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('res.user').clear_allowed_channels_cache()
+        return super(ReadUser, cls).create(vlist)
+
+    @classmethod
+    def write(cls, read_users, values, *args):
+        Pool().get('res.user').clear_allowed_channels_cache()
+        super(ReadUser, cls).write(read_users, values, *args)
+
+    @classmethod
+    def delete(cls, read_users):
+        Pool().get('res.user').clear_allowed_channels_cache()
+        super(ReadUser, cls).delete(read_users)
+
 
 class WriteUser(ModelSQL):
     """
@@ -748,6 +1560,21 @@ class WriteUser(ModelSQL):
         'res.user', 'User', ondelete='RESTRICT', required=True
     )
 
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('res.user').clear_allowed_channels_cache()
+        return super(WriteUser, cls).create(vlist)
+
+    @classmethod
+    def write(cls, write_users, values, *args):
+        Pool().get('res.user').clear_allowed_channels_cache()
+        super(WriteUser, cls).write(write_users, values, *args)
+
+    @classmethod
+    def delete(cls, write_users):
+        Pool().get('res.user').clear_allowed_channels_cache()
+        super(WriteUser, cls).delete(write_users)
+
 
 class ChannelException(ModelSQL, ModelView):
     """
@@ -763,6 +1590,60 @@ class ChannelException(ModelSQL, ModelView):
         "sale.channel", "Channel", required=True, readonly=True
     )
     is_resolved = fields.Boolean("Is Resolved ?", select=True, readonly=True)
+    resolved_at = fields.DateTime("Resolved At", readonly=True)
+
+    # The origin split in model and id to look up exceptions of records
+    # with an index
+    origin_model = fields.Char('Origin Model', readonly=True)
+    origin_id = fields.Integer('Origin ID', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        sql_table = cls.__table__()
+
+        migrate_origin = False
+        if TableHandler.table_exist(cursor, cls._table):
+            table = TableHandler(cursor, cls, module_name)
+            migrate_origin = not table.column_exist('origin_id')
+
+        super(ChannelException, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+
+        # Migration: split origin in origin_model and origin_id
+        if migrate_origin:  # pragma: nocover
+            separator = Position(',', sql_table.origin)
+            cursor.execute(*sql_table.update(
+                columns=[sql_table.origin_model, sql_table.origin_id],
+                values=[
+                    Substring(sql_table.origin, 1, separator - 1),
+                    Cast(
+                        Substring(sql_table.origin, separator + 1),
+                        cls.origin_id.sql_type().base
+                    ),
+                ],
+                where=(sql_table.origin != Null) & (separator > 0)
+            ))
+
+        table.index_action(['origin_model', 'origin_id'], action='add')
+
+        # Partial index on the unresolved exceptions, which are the only
+        # ones looked up by origin while processing orders
+        if backend.name() == 'postgresql':  # pragma: nocover
+            index_name = cls._table + '_unresolved_origin_index'
+            cursor.execute(
+                'SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                (index_name,)
+            )
+            if not cursor.fetchone():
+                cursor.execute(
+                    'CREATE INDEX "' + index_name + '" '
+                    'ON "' + cls._table + '" '
+                    '("origin_model", "origin_id", "channel") '
+                    'WHERE NOT "is_resolved"'
+                )
 
     @classmethod
     def __setup__(cls):
@@ -785,16 +1666,128 @@ class ChannelException(ModelSQL, ModelView):
 
         :param channels: List of active records of exceptions
         """
-        for exception in exceptions:
-            if exception.is_resolved:
-                continue
-            exception.is_resolved = True
-            exception.save()
+        cls.resolve([e for e in exceptions if not e.is_resolved])
+
+    @classmethod
+    def resolve(cls, exceptions):
+        """
+        Mark the exceptions as resolved with a single write
+
+        :param exceptions: List of active records of exceptions
+        """
+        if exceptions:
+            cls.write(exceptions, {'is_resolved': True})
+
+    @classmethod
+    def archive_resolved(cls, days=None):
+        """
+        Move the exceptions resolved more than the given number of days ago
+        to the archive, keeping the table of exceptions small.
+
+        The age defaults to the `exception_archive_days` option of the
+        `sale_channel` section of the trytond configuration (90 days).
+
+        :param days: Minimum age in days of the resolutions to archive
+        :return: Number of exceptions archived
+        """
+        Archive = Pool().get('channel.exception.archive')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        archive = Archive.__table__()
+
+        if days is None:
+            days = config.getint(
+                'sale_channel', 'exception_archive_days', default=90
+            )
+        resolved_at = Coalesce(
+            table.resolved_at, table.write_date, table.create_date
+        )
+        cursor.execute(*table.select(
+            table.id,
+            where=table.is_resolved &
+            (resolved_at < datetime.utcnow() - timedelta(days=days))
+        ))
+        exception_ids = [exception_id for exception_id, in cursor.fetchall()]
+
+        for sub_ids in grouped_slice(exception_ids):
+            where = table.id.in_(list(sub_ids))
+            cursor.execute(*archive.insert(
+                columns=[
+                    archive.channel, archive.origin, archive.log,
+                    archive.exception_date, archive.resolved_at,
+                    archive.create_uid, archive.create_date,
+                ],
+                values=table.select(
+                    table.channel, table.origin, table.log,
+                    table.create_date, resolved_at,
+                    Literal(Transaction().user), CurrentTimestamp(),
+                    where=where
+                )
+            ))
+            cursor.execute(*table.delete(where=where))
+        return len(exception_ids)
+
+    @classmethod
+    def archive_resolved_using_cron(cls):  # pragma: nocover
+        """
+        Cron method to archive resolved exceptions
+        """
+        cls.archive_resolved()
 
     @staticmethod
     def default_is_resolved():
         return False
 
+    @staticmethod
+    def split_origin(origin):
+        """
+        Return the model name and the id of an origin value
+
+        :param origin: Origin as a string or a tuple of model and id
+        :return: Tuple of model name and id, or (None, None)
+        """
+        if not origin:
+            return None, None
+        if isinstance(origin, basestring):
+            model, _, record_id = origin.partition(',')
+        else:
+            model, record_id = origin
+        try:
+            record_id = int(record_id)
+        except (TypeError, ValueError):
+            return None, None
+        if record_id < 0:
+            return None, None
+        return model, record_id
+
+    @classmethod
+    def _set_computed_values(cls, values):
+        """
+        Set the split origin and the resolution date from the values
+        """
+        values = values.copy()
+        if 'origin' in values:
+            values['origin_model'], values['origin_id'] = cls.split_origin(
+                values['origin']
+            )
+        if 'is_resolved' in values and 'resolved_at' not in values:
+            values['resolved_at'] = \
+                datetime.utcnow() if values['is_resolved'] else None
+        return values
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [cls._set_computed_values(values) for values in vlist]
+        return super(ChannelException, cls).create(vlist)
+
+    @classmethod
+    def write(cls, exceptions, values, *args):
+        actions = iter((exceptions, values) + args)
+        args = []
+        for records, values in zip(actions, actions):
+            args.extend((records, cls._set_computed_values(values)))
+        super(ChannelException, cls).write(*args)
+
     @classmethod
     def models_get(cls):
         '''
@@ -806,6 +1799,30 @@ class ChannelException(ModelSQL, ModelView):
         ]
 
 
+class ChannelExceptionArchive(ModelSQL, ModelView):
+    """
+    Channel Exception Archive
+
+    Resolved channel exceptions are moved here once they are old enough, see
+    `ChannelException.archive_resolved`.
+    """
+    __name__ = 'channel.exception.archive'
+
+    channel = fields.Many2One(
+        "sale.channel", "Channel", required=True, readonly=True, select=True,
+        ondelete='CASCADE'
+    )
+    origin = fields.Char("Origin", readonly=True)
+    log = fields.Text('Exception Log', readonly=True)
+    exception_date = fields.DateTime('Exception Date', readonly=True)
+    resolved_at = fields.DateTime('Resolved At', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ChannelExceptionArchive, cls).__setup__()
+        cls._order.insert(0, ('resolved_at', 'DESC'))
+
+
 class ChannelOrderState(ModelSQL, ModelView):
     """
     Sale Channel - Tryton Order State map
@@ -842,11 +1859,52 @@ class ChannelOrderState(ModelSQL, ModelView):
         ondelete="CASCADE", readonly=True
     )
 
+    _map_cache = Cache('sale.channel.order_state.get_map', context=False)
+
     @staticmethod
     def default_channel():
         "Return default channel from context"
         return Transaction().context.get('current_channel')
 
+    @classmethod
+    def create(cls, vlist):
+        cls._map_cache.clear()
+        return super(ChannelOrderState, cls).create(vlist)
+
+    @classmethod
+    def write(cls, order_states, values, *args):
+        cls._map_cache.clear()
+        super(ChannelOrderState, cls).write(order_states, values, *args)
+
+    @classmethod
+    def delete(cls, order_states):
+        cls._map_cache.clear()
+        super(ChannelOrderState, cls).delete(order_states)
+
+    @classmethod
+    def get_map(cls, channel_id):
+        """
+        Return the order states of the channel as a dictionary of code and
+        list of the order states with that code. Each order state is a
+        dictionary of id, action, invoice_method and shipment_method.
+
+        The map is cached until an order state is modified.
+
+        :param channel_id: ID of the channel
+        """
+        states_map = cls._map_cache.get(channel_id)
+        if states_map is None:
+            states_map = {}
+            for order_state in cls.search([('channel', '=', channel_id)]):
+                states_map.setdefault(order_state.code, []).append({
+                    'id': order_state.id,
+                    'action': order_state.action,
+                    'invoice_method': order_state.invoice_method,
+                    'shipment_method': order_state.shipment_method,
+                })
+            cls._map_cache.set(channel_id, states_map)
+        return states_map
+
 
 class TaxMapping(ModelSQL, ModelView):
     'Sale Tax'
@@ -857,6 +1915,8 @@ class TaxMapping(ModelSQL, ModelView):
     tax = fields.Many2One("account.tax", "Tax", required=True)
     channel = fields.Many2One("sale.channel", "Channel", required=True)
 
+    _index_cache = Cache('sale.channel.tax.get_index', context=False)
+
     @classmethod
     def __setup__(cls):
         super(TaxMapping, cls).__setup__()
@@ -869,3 +1929,262 @@ class TaxMapping(ModelSQL, ModelView):
             ('unique_tax_percent', 'UNIQUE(channel, name, rate)',
              'unique_tax_rate_per_channel')
         ]
+
+    @classmethod
+    def create(cls, vlist):
+        cls._index_cache.clear()
+        return super(TaxMapping, cls).create(vlist)
+
+    @classmethod
+    def write(cls, mappings, values, *args):
+        cls._index_cache.clear()
+        super(TaxMapping, cls).write(mappings, values, *args)
+
+    @classmethod
+    def delete(cls, mappings):
+        cls._index_cache.clear()
+        super(TaxMapping, cls).delete(mappings)
+
+    @staticmethod
+    def index_key(name, rate):
+        """
+        Return the key of the tax mapping index for name and rate. The key
+        of a mapping without name matches on rate only.
+        """
+        if isinstance(rate, float):
+            rate = Decimal(str(rate))
+        return (name or None, rate)
+
+    @classmethod
+    def get_index(cls, channel_id):
+        """
+        Return the tax mappings of the channel as a dictionary of the key
+        from `index_key` and the list of tax ids mapped. Mappings are
+        indexed both by name and rate and by rate only.
+
+        The index is cached until a tax mapping is modified.
+
+        :param channel_id: ID of the channel
+        """
+        index = cls._index_cache.get(channel_id)
+        if index is None:
+            index = {}
+            for mapping in cls.search([('channel', '=', channel_id)]):
+                for name in (mapping.name, None):
+                    index.setdefault(
+                        cls.index_key(name, mapping.rate), []
+                    ).append(mapping.tax.id)
+            cls._index_cache.set(channel_id, index)
+        return index
+
+
+class ChannelInventoryChange(ModelSQL):
+    """
+    Sale Channel Inventory Change
+
+    This model keeps a log of listings whose inventory has to be exported
+    again to their channel. A record is logged for every active listing of a
+    product whenever a stock move of the product is created, updated or
+    deleted and whenever the listing itself is created or updated. The log
+    for a channel is cleared once its inventory has been exported. Changes
+    of channels which do not export inventory are compacted daily to the
+    last change of each listing by `compact_changes`, so the log never holds
+    more records than there are listings.
+    """
+    __name__ = 'sale.channel.inventory_change'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    listing = fields.Many2One(
+        'product.product.channel_listing', 'Listing', required=True,
+        select=True, ondelete='CASCADE'
+    )
+
+    @classmethod
+    def _log_listings(cls, field_name, ids):
+        """
+        Log a change for all active listings with the given values of field
+        """
+        Listing = Pool().get('product.product.channel_listing')
+        cursor = Transaction().cursor
+
+        table = cls.__table__()
+        listing = Listing.__table__()
+        column = Column(listing, field_name)
+
+        for sub_ids in grouped_slice(list(set(ids))):
+            cursor.execute(*table.insert(
+                columns=[
+                    table.channel, table.listing,
+                    table.create_uid, table.create_date,
+                ],
+                values=listing.select(
+                    listing.channel, listing.id,
+                    Literal(Transaction().user), CurrentTimestamp(),
+                    where=column.in_(list(sub_ids)) &
+                    (listing.state == 'active')
+                )
+            ))
+
+    @classmethod
+    def log_products(cls, product_ids):
+        """
+        Log a change for all active listings of the given products
+
+        :param product_ids: List of product ids whose stock changed
+        """
+        cls._log_listings('product', product_ids)
+
+    @classmethod
+    def log_listings(cls, listing_ids):
+        """
+        Log a change for the given listings
+
+        :param listing_ids: List of listing ids which changed
+        """
+        cls._log_listings('id', listing_ids)
+
+    @classmethod
+    def get_last_change(cls, channel):
+        """
+        Return the id of the last change logged for the channel
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.select(
+            Max(table.id), where=table.channel == channel.id
+        ))
+        return cursor.fetchone()[0]
+
+    @classmethod
+    def get_changed_listings(
+            cls, channel, last_change=None, after=None, limit=None):
+        """
+        Return the sorted ids of the active listings of the channel which
+        have changes logged.
+
+        :param channel: Active record of the channel
+        :param last_change: If given, changes logged after it are ignored
+        :param after: If given, only the listings with a greater id are
+                      returned
+        :param limit: If given, the maximum number of ids returned
+        """
+        Listing = Pool().get('product.product.channel_listing')
+        cursor = Transaction().cursor
+
+        table = cls.__table__()
+        listing = Listing.__table__()
+
+        where = (table.channel == channel.id) & (listing.state == 'active')
+        if last_change is not None:
+            where &= table.id <= last_change
+        if after is not None:
+            where &= table.listing > after
+
+        cursor.execute(*table.join(
+            listing, condition=table.listing == listing.id
+        ).select(
+            table.listing, where=where, group_by=table.listing,
+            order_by=table.listing.asc, limit=limit
+        ))
+        return map(lambda r: r[0], cursor.fetchall())
+
+    @classmethod
+    def get_changes(cls, channel, last_change=None, listing_ids=None):
+        """
+        Return the changes logged for the channel as a dictionary of listing
+        id and the list of ids of its changes.
+
+        :param channel: Active record of the channel
+        :param last_change: If given, changes logged after it are ignored
+        :param listing_ids: If given, only the changes of these listings are
+                            returned
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        where = table.channel == channel.id
+        if last_change is not None:
+            where &= table.id <= last_change
+
+        if listing_ids is None:
+            wheres = [where]
+        else:
+            wheres = [
+                where & table.listing.in_(list(sub_ids))
+                for sub_ids in grouped_slice(listing_ids)
+            ]
+
+        changes = defaultdict(list)
+        for sub_where in wheres:
+            cursor.execute(*table.select(
+                table.listing, table.id, where=sub_where
+            ))
+            for listing_id, change_id in cursor.fetchall():
+                changes[listing_id].append(change_id)
+        return dict(changes)
+
+    @classmethod
+    def get_inactive_changes(cls, channel, last_change=None):
+        """
+        Return the ids of the changes logged for the listings of the channel
+        which are not active. They are never exported.
+
+        :param channel: Active record of the channel
+        :param last_change: If given, changes logged after it are ignored
+        """
+        Listing = Pool().get('product.product.channel_listing')
+        cursor = Transaction().cursor
+
+        table = cls.__table__()
+        listing = Listing.__table__()
+
+        where = (table.channel == channel.id) & (listing.state != 'active')
+        if last_change is not None:
+            where &= table.id <= last_change
+
+        cursor.execute(*table.join(
+            listing, condition=table.listing == listing.id
+        ).select(table.id, where=where))
+        return map(lambda r: r[0], cursor.fetchall())
+
+    @classmethod
+    def delete_changes(cls, change_ids):
+        """
+        Delete the given changes once they are exported
+
+        :param change_ids: List of ids of changes
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        for sub_ids in grouped_slice(change_ids):
+            cursor.execute(*table.delete(where=table.id.in_(list(sub_ids))))
+
+    @classmethod
+    def compact_changes(cls):
+        """
+        Delete the changes which are followed by a later change of the same
+        listing. The last change of a listing is kept, so a listing is
+        exported by the next export whether or not its earlier changes were
+        read by an export running meanwhile.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        last = cls.__table__()
+
+        cursor.execute(*table.delete(
+            where=~table.id.in_(
+                last.select(Max(last.id), group_by=last.listing)
+            )
+        ))
+
+    @classmethod
+    def compact_changes_using_cron(cls):  # pragma: nocover
+        """
+        Cron method to compact the inventory change log
+        """
+        cls.compact_changes()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    checkpoint.py
+
+"""
+from datetime import datetime
+
+from trytond.model import ModelSQL, fields
+from trytond.transaction import Transaction
+
+__all__ = ['ChannelCheckpoint']
+
+
+class ChannelCheckpoint(ModelSQL):
+    """
+    Sale Channel Checkpoint
+
+    A checkpoint records the progress of an export stream of a channel while
+    it runs. The progress is committed in a separate transaction after each
+    batch, so that an interrupted export resumes after the last committed
+    batch instead of starting over. The checkpoint is deleted once the export
+    completes.
+
+    A checkpoint stores:
+
+        started_at: Time at which the interrupted run started, to be used as
+                    the time of the export once it completes
+        watermark: Stream specific upper bound of the records to export, like
+                   the last inventory change of the inventory stream
+        position: ID of the last record exported, records are exported in
+                  the order of their ids
+    """
+    __name__ = 'sale.channel.checkpoint'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, select=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    stream = fields.Selection([
+        ('inventory', 'Inventory'),
+        ('product_prices', 'Product Prices'),
+        ('order_status', 'Order Status'),
+        ('shipments', 'Shipments'),
+        ('products', 'Products'),
+    ], 'Stream', required=True, readonly=True)
+    started_at = fields.DateTime('Started At', required=True, readonly=True)
+    watermark = fields.Integer('Watermark', readonly=True)
+    position = fields.Integer('Position', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ChannelCheckpoint, cls).__setup__()
+        cls._error_messages.update({
+            'unique_stream_per_channel':
+                'Only one checkpoint per stream and channel is allowed',
+        })
+        cls._sql_constraints += [
+            ('unique_stream_per_channel', 'UNIQUE(channel, stream)',
+             'unique_stream_per_channel'),
+        ]
+
+    @classmethod
+    def get_checkpoint(cls, channel, stream):
+        """
+        Return the checkpoint of the stream of the channel as a dictionary of
+        id, started_at, watermark and position, or None if there is none.
+        """
+        checkpoints = cls.search([
+            ('channel', '=', channel.id),
+            ('stream', '=', stream),
+        ])
+        if not checkpoints:
+            return None
+        checkpoint, = checkpoints
+        return {
+            'id': checkpoint.id,
+            'started_at': checkpoint.started_at,
+            'watermark': checkpoint.watermark,
+            'position': checkpoint.position,
+        }
+
+    @classmethod
+    def start(cls, channel, stream, watermark=None):
+        """
+        Return the checkpoint of an interrupted run of the stream to resume
+        it, or start a new one. A new checkpoint is committed in a separate
+        transaction, so it outlives a crash of the current one.
+
+        :param channel: Active record of the channel
+        :param stream: Name of the stream
+        :param watermark: Upper bound of the records to export by a new run
+        :return: Dictionary of the checkpoint, see `get_checkpoint`
+        """
+        with Transaction().new_cursor() as txn:
+            checkpoint = cls.get_checkpoint(channel, stream)
+            if checkpoint is None:
+                cls.create([{
+                    'channel': channel.id,
+                    'stream': stream,
+                    'started_at': datetime.utcnow(),
+                    'watermark': watermark,
+                }])
+                checkpoint = cls.get_checkpoint(channel, stream)
+                txn.cursor.commit()
+        return checkpoint
+
+    @classmethod
+    def save_position(cls, checkpoint_id, position):
+        """
+        Record the position of the checkpoint. Callers save it in a separate
+        transaction along with the effects of the batch exported, so that
+        both are committed together.
+
+        :param checkpoint_id: ID of the checkpoint
+        :param position: ID of the last record exported
+        """
+        cls.write([cls(checkpoint_id)], {'position': position})
+
+    @staticmethod
+    def get_remaining_ids(ids, checkpoint):
+        """
+        Return the sorted ids which are left to export after the position of
+        the checkpoint.
+        """
+        position = checkpoint and checkpoint['position']
+        return sorted(i for i in ids if not position or i > position)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    claim.py
+
+"""
+import zlib
+
+from trytond import backend
+from trytond.model import Model
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['ChannelOrderClaim']
+
+# First key of the advisory locks claiming orders
+LOCK_NAMESPACE = zlib.crc32('sale.channel.order_claim')
+
+
+class ChannelOrderClaim(Model):
+    """
+    Sale Channel Order Claim
+
+    A claim reserves the import of an order for the transaction importing
+    it, so that workers importing orders concurrently do not import an order
+    twice.
+
+    On PostgreSQL, a claim is a transaction level advisory lock on the
+    identifier of the order. It is released when the importing transaction
+    commits or rolls back: the orders of an import which failed can be
+    claimed again at once, and the sales of an import which succeeded are
+    committed by the time another transaction can claim their orders.
+    """
+    __name__ = 'sale.channel.order_claim'
+
+    @classmethod
+    def claim(cls, identifiers):
+        """
+        Claim the import of the orders until the end of the current
+        transaction
+
+        SQLite runs one writing transaction at a time, so no lock is needed
+        there.
+
+        :param identifiers: List of channel identifiers of the orders
+        :return: List of the identifiers claimed, the others are claimed by
+                 another transaction or already imported
+        """
+        identifiers = sorted(set(identifiers))
+        if backend.name() == 'postgresql':
+            identifiers = cls.lock(identifiers)  # pragma: nocover
+        imported = cls.get_imported(identifiers)
+        return [i for i in identifiers if i not in imported]
+
+    @classmethod
+    def lock(cls, identifiers):  # pragma: nocover
+        """
+        Take the advisory locks of the orders which are not locked by
+        another transaction
+
+        :return: List of the identifiers locked
+        """
+        cursor = Transaction().cursor
+        locked = []
+        for sub_identifiers in grouped_slice(identifiers):
+            cursor.execute(
+                'SELECT identifier FROM unnest(%s) AS identifier '
+                'WHERE pg_try_advisory_xact_lock(%s, hashtext(identifier))',
+                (list(sub_identifiers), LOCK_NAMESPACE)
+            )
+            locked.extend(i for i, in cursor.fetchall())
+        return sorted(locked)
+
+    @classmethod
+    def get_imported(cls, identifiers):
+        """
+        Return the identifiers of the orders already imported, whatever the
+        channel of the sale. They are read in a separate transaction, which
+        sees the sales committed since the current transaction started,
+        including those of the transactions which held the claims before.
+
+        :param identifiers: List of channel identifiers of the orders
+        :return: Set of the identifiers imported
+        """
+        Sale = Pool().get('sale.sale')
+        sale = Sale.__table__()
+
+        imported = set()
+        with Transaction().new_cursor() as txn:
+            cursor = txn.cursor
+            for sub_identifiers in grouped_slice(identifiers):
+                cursor.execute(*sale.select(
+                    sale.channel_identifier,
+                    where=sale.channel_identifier.in_(list(sub_identifiers))
+                ))
+                imported.update(i for i, in cursor.fetchall())
+        return imported
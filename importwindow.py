@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    importwindow.py
+
+"""
+import logging
+from datetime import timedelta
+
+from trytond.model import ModelView, ModelSQL, fields
+
+__all__ = ['ChannelImportWindow']
+
+logger = logging.getLogger('sale_channel')
+
+
+class ChannelImportWindow(ModelSQL, ModelView):
+    """
+    Sale Channel Import Window
+
+    A slice of time whose orders are imported by a channel job. The time
+    since the last order import of a channel is split in windows which are
+    imported in parallel by the job workers, see
+    `SaleChannel.plan_order_import`. The last order import time of the
+    channel is moved to the end of a window once it and all the windows
+    before it are done or failed.
+
+    A window fails when its job fails for good. It is kept, with a warning
+    logged, so that its job can be retried, but it does not hold back the
+    last order import time.
+    """
+    __name__ = 'sale.channel.import_window'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, select=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    start = fields.DateTime('Start', required=True, readonly=True)
+    end = fields.DateTime('End', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, select=True, readonly=True)
+    job = fields.Many2One('sale.channel.job', 'Job', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ChannelImportWindow, cls).__setup__()
+        cls._order.insert(0, ('start', 'ASC'))
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def split(start, end, size):
+        """
+        Split the time from start to end in windows
+
+        :param start: Start datetime
+        :param end: End datetime
+        :param size: Maximum duration of a window in seconds
+        :return: List of tuples of start and end of the windows, the last
+                 window may be shorter
+        """
+        size = timedelta(seconds=size)
+        windows = []
+        while start < end:
+            windows.append((start, min(start + size, end)))
+            start = windows[-1][1]
+        return windows
+
+    @staticmethod
+    def get_done_prefix(windows):
+        """
+        Return the windows which are done or failed and not preceded by a
+        window which is pending
+
+        :param windows: List of active records of windows ordered by start
+        """
+        done = []
+        for window in windows:
+            if window.state == 'pending':
+                break
+            done.append(window)
+        return done
+
+    @classmethod
+    def fail_jobs(cls, jobs):
+        """
+        Mark as failed the pending windows imported by jobs which failed for
+        good
+
+        :param jobs: List of active records of failed jobs
+        """
+        windows = cls.search([
+            ('job', 'in', map(int, jobs)),
+            ('state', '=', 'pending'),
+        ])
+        for window in windows:
+            logger.warning(
+                'Orders of channel %s from %s to %s not imported, job %s '
+                'failed', window.channel.id, window.start, window.end,
+                window.job.id
+            )
+        if windows:
+            cls.write(windows, {'state': 'failed'})
+        return windows
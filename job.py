@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+    job.py
+
+"""
+import logging
+from datetime import datetime, timedelta
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+
+from channel import ChannelWorkerPool
+
+__all__ = ['SaleChannelJob']
+
+logger = logging.getLogger('sale_channel')
+
+
+class SaleChannelJob(ModelSQL, ModelView):
+    """
+    Sale Channel Job
+
+    A job runs an import or export operation of a channel in the background.
+    Jobs are queued by the import / export wizards and processed by a cron,
+    each job in its own transaction. Failed jobs are retried with an
+    exponential backoff until the maximum number of attempts is reached.
+
+    The delays are configured in the `sale_channel` section of the trytond
+    configuration:
+
+        job_retry_delay: Seconds before the first retry (default 60)
+        job_timeout: Seconds after which a running job is considered dead and
+                     is picked up again (default 3600)
+    """
+    __name__ = 'sale.channel.job'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, select=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    operation = fields.Selection([
+        ('import_orders', 'Import Orders'),
+        ('import_order_window', 'Import Order Window'),
+        ('import_products', 'Import Products'),
+        ('import_product', 'Import Product'),
+        ('export_order_status', 'Export Order Status'),
+        ('export_product_prices', 'Export Product Prices'),
+        ('export_inventory', 'Export Inventory'),
+    ], 'Operation', required=True, readonly=True)
+    argument = fields.Char('Argument', readonly=True)
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, select=True, readonly=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    max_attempts = fields.Integer(
+        'Max Attempts', required=True, states={
+            'readonly': Eval('state') != 'queued',
+        }, depends=['state']
+    )
+    next_attempt = fields.DateTime('Next Attempt', select=True, readonly=True)
+    started_at = fields.DateTime('Started At', readonly=True)
+    finished_at = fields.DateTime('Finished At', readonly=True)
+    processed = fields.Integer('Processed', readonly=True)
+    total = fields.Integer('Total', readonly=True)
+    message = fields.Text('Message', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(SaleChannelJob, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+        cls._buttons.update({
+            'retry': {
+                'invisible': Eval('state') != 'failed',
+            },
+        })
+
+    @staticmethod
+    def default_state():
+        return 'queued'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @staticmethod
+    def default_max_attempts():
+        return 3
+
+    @staticmethod
+    def default_next_attempt():
+        return datetime.utcnow()
+
+    @staticmethod
+    def default_processed():
+        return 0
+
+    def get_rec_name(self, name):
+        return '%s #%d' % (self.channel.rec_name, self.id)
+
+    @classmethod
+    def enqueue(cls, channel, operation, argument=None, delay=None):
+        """
+        Queue an operation to run on the channel
+
+        :param channel: Active record of the channel
+        :param operation: Name of the method of the channel to call
+        :param argument: Optional argument passed to the method
+        :param delay: Optional number of seconds before the job is run
+        :return: Active record of the job created
+        """
+        values = {
+            'channel': channel.id,
+            'operation': operation,
+            'argument': argument,
+        }
+        if delay:
+            values['next_attempt'] = datetime.utcnow() + timedelta(
+                seconds=delay
+            )
+        job, = cls.create([values])
+        return job
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, jobs):
+        """
+        Queue failed jobs again
+        """
+        cls.write(jobs, {
+            'state': 'queued',
+            'attempts': 0,
+            'next_attempt': datetime.utcnow(),
+            'message': None,
+        })
+
+    @classmethod
+    def process_queue(cls):
+        """
+        Cron method to process the jobs which are due
+
+        Jobs are claimed `job_claim_limit` at a time (`sale_channel` section
+        of the trytond configuration, default 10), so that the jobs are
+        shared between the workers running the cron. The jobs claimed are
+        run in parallel by the pool of `workers` threads used to run the
+        channels, see `SaleChannel.run_for_channels`. On SQLite or with a
+        single worker they are run one after the other.
+
+        At most `job_claim_rounds` batches of jobs (default 1) are claimed
+        per call, so that a steady flow of jobs does not hold back the other
+        crons, which are run one after the other. The jobs left are picked up
+        by the next run of the cron.
+        """
+        limit = config.getint('sale_channel', 'job_claim_limit', default=10)
+        rounds = config.getint('sale_channel', 'job_claim_rounds', default=1)
+        workers = config.getint('sale_channel', 'workers', default=4)
+        for _ in xrange(rounds):
+            job_ids = cls.claim_jobs(limit=limit)
+            if not job_ids:
+                break
+            if workers <= 1 or backend.name() == 'sqlite':
+                for job_id in job_ids:
+                    cls.process_job(job_id)
+            else:
+                cls.process_jobs_in_pool(  # pragma: nocover
+                    job_ids, workers
+                )
+
+    @classmethod
+    def process_jobs_in_pool(cls, job_ids, workers):  # pragma: nocover
+        """
+        Run claimed jobs in a pool of worker threads, each job in its own
+        transaction, and wait for all of them to finish. Jobs running for
+        too long are picked up again by `claim_jobs` after `job_timeout`
+        seconds, so the pool does not time them out.
+        """
+        transaction = Transaction()
+        database_name = transaction.cursor.database_name
+        user = transaction.user
+        context = transaction.context.copy()
+
+        def work(job_id):
+            with Transaction().start(database_name, user, context=context):
+                cls.process_job(job_id)
+            return ('done', '')
+
+        ChannelWorkerPool(workers).map(work, job_ids, 'Channel job %s')
+
+    @classmethod
+    def claim_jobs(cls, limit=None):
+        """
+        Mark the jobs which are due as running in a separate transaction, so
+        that other workers do not pick them up.
+
+        Running jobs which timed out are claimed again, unless they reached
+        their maximum number of attempts, in which case they are marked as
+        failed.
+
+        :return: List of ids of the jobs claimed
+        """
+        ImportWindow = Pool().get('sale.channel.import_window')
+
+        now = datetime.utcnow()
+        timeout = config.getint('sale_channel', 'job_timeout', default=3600)
+
+        with Transaction().new_cursor() as txn:
+            if backend.name() == 'postgresql':
+                # Wait for the other workers claiming jobs, the lock of
+                # the cursor does not wait and would fail
+                txn.cursor.execute(  # pragma: nocover
+                    'LOCK "%s" IN EXCLUSIVE MODE' % cls._table
+                )
+            jobs = cls.search([
+                'OR', [
+                    ('state', '=', 'queued'),
+                    ('next_attempt', '<=', now),
+                ], [
+                    ('state', '=', 'running'),
+                    ('started_at', '<', now - timedelta(seconds=timeout)),
+                ]
+            ], order=[('next_attempt', 'ASC'), ('id', 'ASC')], limit=limit)
+            claimed, failed = [], []
+            for job in jobs:
+                if job.state == 'running' and \
+                        job.attempts >= job.max_attempts:
+                    job.state = 'failed'
+                    job.finished_at = now
+                    job.message = 'Timed out after %s seconds' % timeout
+                    failed.append(job)
+                else:
+                    job.state = 'running'
+                    job.attempts += 1
+                    job.started_at = now
+                    job.finished_at = None
+                    claimed.append(job)
+                job.save()
+            if failed:
+                ImportWindow.fail_jobs(failed)
+            txn.cursor.commit()
+        return map(int, claimed)
+
+    @classmethod
+    def process_job(cls, job_id):
+        """
+        Run a claimed job in a separate transaction and record its outcome
+
+        The job transaction does not write the job: its progress is saved by
+        `report_progress` in separate transactions and its outcome is
+        recorded in another transaction once the job transaction is
+        finished, so that it is not based on a snapshot older than the
+        progress saved.
+        """
+        SyncLog = Pool().get('sale.channel.sync_log')
+
+        stats = {}
+        with Transaction().new_cursor() as txn:
+            job = cls(job_id)
+            try:
+                with SyncLog.measure(stats):
+                    result = job.run()
+            except Exception, exc:
+                logger.exception('Channel job %s failed', job_id)
+                txn.cursor.rollback()
+                error = exc
+            else:
+                txn.cursor.commit()
+                error = None
+                stats['records'] = SyncLog.count_records(result)
+            Cache.resets(txn.cursor.database_name)
+
+        with Transaction().new_cursor() as txn:
+            job = cls(job_id)
+            if error is None:
+                job.handle_success(result)
+                outcome = ('done', '')
+            else:
+                job.handle_failure(error)
+                outcome = ('failed', job.message)
+            SyncLog.log(job.channel.id, job.operation, outcome, stats)
+            txn.cursor.commit()
+
+    def run(self):
+        """
+        Run the operation of the job in the current transaction. The id of
+        the job is available in the context as `channel_job`.
+
+        :return: The value returned by the operation
+        """
+        with Transaction().set_context(
+                company=self.channel.company.id, channel_job=self.id):
+            method = getattr(self.channel, self.operation)
+            if self.argument:
+                return method(self.argument)
+            return method()
+
+    def handle_success(self, result):
+        """
+        Mark the job as done
+        """
+        self.state = 'done'
+        self.finished_at = datetime.utcnow()
+        if isinstance(result, list):
+            self.processed = len(result)
+        self.save()
+
+    def handle_failure(self, exception):
+        """
+        Queue the job again with an exponential backoff or mark it as failed
+        if it can not be retried, along with the import window it imports.
+        """
+        ImportWindow = Pool().get('sale.channel.import_window')
+
+        delay = config.getint('sale_channel', 'job_retry_delay', default=60)
+
+        self.finished_at = datetime.utcnow()
+        self.message = unicode(exception)
+        if isinstance(exception, NotImplementedError) or \
+                self.attempts >= self.max_attempts:
+            self.state = 'failed'
+        else:
+            self.state = 'queued'
+            self.next_attempt = self.finished_at + timedelta(
+                seconds=delay * 2 ** max(self.attempts - 1, 0)
+            )
+        self.save()
+        if self.state == 'failed':
+            ImportWindow.fail_jobs([self])
+
+    @classmethod
+    def report_progress(cls, processed, total=None):
+        """
+        Record the progress of the job running in the current context. The
+        progress is saved in a separate transaction to be visible while the
+        job is running. Nothing is done outside of a job.
+
+        :param processed: Number of records processed so far
+        :param total: Total number of records to process if known
+        """
+        job_id = Transaction().context.get('channel_job')
+        if not job_id:
+            return
+
+        values = {'processed': processed}
+        if total is not None:
+            values['total'] = total
+        with Transaction().new_cursor() as txn:
+            cls.write([cls(job_id)], values)
+            txn.cursor.commit()
+
+    @classmethod
+    def get_jobs_message(cls, jobs):
+        """
+        Return a message to show to the user once jobs are queued
+        """
+        operations = dict(cls.operation.selection)
+        return '\n'.join(
+            'Job #%d queued: %s' % (job.id, operations[job.operation])
+            for job in jobs
+        )
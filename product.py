@@ -13,11 +13,17 @@ Implementing Add listing wizard for downstream modules:
   views or transitions. Eventually it should end with the `end` state.
 
 """
+import hashlib
+from collections import defaultdict
+
+from trytond.cache import freeze
+from trytond.config import config
 from trytond.pool import PoolMeta, Pool
 from trytond.wizard import Wizard, Button, StateTransition, StateView
 from trytond.transaction import Transaction
 from trytond.model import ModelView, fields, ModelSQL
 from trytond.pyson import Eval, Bool
+from trytond.tools import grouped_slice
 
 __metaclass__ = PoolMeta
 __all__ = [
@@ -173,6 +179,21 @@ class ProductSaleChannelListing(ModelSQL, ModelView):
         'get_availability_fields'
     )
 
+    # Snapshot of the availability last exported to the channel, used to
+    # skip listings whose availability did not change
+    last_exported_availability_type = fields.Char(
+        'Last Exported Type', readonly=True
+    )
+    last_exported_availability = fields.Char(
+        'Last Exported Availability', readonly=True
+    )
+    last_exported_quantity = fields.Float(
+        'Last Exported Quantity', readonly=True
+    )
+    last_exported_availability_hash = fields.Char(
+        'Last Exported Availability Hash', readonly=True
+    )
+
     def get_unit_digits(self, name):
         if self.product:
             self.product.default_uom.digits
@@ -185,8 +206,9 @@ class ProductSaleChannelListing(ModelSQL, ModelView):
             'availability_used': {},
             'quantity': {}
         }
+        availabilities = cls.get_availabilities(listings)
         for listing in listings:
-            availability = listing.get_availability()
+            availability = availabilities[listing.id]
             values['availability_type_used'][listing.id] = availability['type']
             values['availability_used'][listing.id] = availability.get(
                 'value'
@@ -220,6 +242,32 @@ class ProductSaleChannelListing(ModelSQL, ModelView):
     def default_state():
         return 'active'
 
+    @classmethod
+    def create(cls, vlist):
+        """
+        Log inventory changes for the created listings
+        """
+        InventoryChange = Pool().get('sale.channel.inventory_change')
+
+        listings = super(ProductSaleChannelListing, cls).create(vlist)
+        InventoryChange.log_listings(map(int, listings))
+        return listings
+
+    @classmethod
+    def write(cls, listings, values, *args):
+        """
+        Log inventory changes for the updated listings
+        """
+        InventoryChange = Pool().get('sale.channel.inventory_change')
+
+        super(ProductSaleChannelListing, cls).write(listings, values, *args)
+
+        all_listings = []
+        actions = iter((listings, values) + args)
+        for records, _ in zip(actions, actions):
+            all_listings.extend(records)
+        InventoryChange.log_listings(map(int, all_listings))
+
     @classmethod
     def create_from(cls, channel, product_data):
         """
@@ -233,7 +281,8 @@ class ProductSaleChannelListing(ModelSQL, ModelView):
     @classmethod
     @ModelView.button
     def export_inventory_button(cls, listings):
-        return cls.export_bulk_inventory(listings)
+        with Transaction().set_context(force_inventory_export=True):
+            return cls.export_bulk_inventory(listings)
 
     def export_inventory(self):
         """
@@ -253,10 +302,155 @@ class ProductSaleChannelListing(ModelSQL, ModelView):
         """
         Export listing.product inventory to listing.channel in bulk
 
+        The listings are exported in chunks, see `iter_export_chunks`.
+        Listings whose availability did not change since it was last
+        exported are skipped, unless the context key
+        `force_inventory_export` is set.
+
+        Each chunk of changed listings is exported by calling this method
+        again with the chunk, so that downstream modules overriding it keep
+        pushing the chunks in bulk. The availabilities of the chunk are then
+        in the context key `inventory_export_availabilities` and the chunk is
+        exported with `export_inventory_chunk`.
+        """
+        availabilities = Transaction().context.get(
+            'inventory_export_availabilities'
+        )
+        if availabilities is not None:
+            cls.export_inventory_chunk(listings, availabilities)
+            return
+
+        listing_ids = map(int, listings)
+        for chunk, availabilities in cls.iter_export_chunks(listing_ids):
+            chunk = cls.export_changed_inventory(chunk, availabilities)
+            cls.save_exported_availabilities(chunk, availabilities)
+
+    @classmethod
+    def export_changed_inventory(cls, listings, availabilities):
+        """
+        Export the inventory of the listings whose availability changed
+        since it was last exported, or of all the listings if the context
+        key `force_inventory_export` is set, through `export_bulk_inventory`.
+        The snapshot of the availabilities exported is left to the caller to
+        save with `save_exported_availabilities`.
+
+        :param listings: List of active records of listings
+        :param availabilities: Dictionary of listing id and its availability
+        :return: List of active records of the listings exported
+        """
+        if not Transaction().context.get('force_inventory_export'):
+            listings = cls.filter_changed_availabilities(
+                listings, availabilities
+            )
+        if listings:
+            with Transaction().set_context(
+                    inventory_export_availabilities=availabilities):
+                cls.export_bulk_inventory(listings)
+        return listings
+
+    @staticmethod
+    def get_availability_hash(availability):
+        """
+        Return a hash of the availability to compare it with the last
+        exported one
+        """
+        return hashlib.sha1(repr(sorted(availability.items()))).hexdigest()
+
+    @classmethod
+    def filter_changed_availabilities(cls, listings, availabilities):
+        """
+        Return the listings whose availability is not the one last exported
+
+        :param listings: List of active records of listings
+        :param availabilities: Dictionary of listing id and its availability
+        """
+        return [
+            listing for listing in listings
+            if listing.last_exported_availability_hash !=
+            cls.get_availability_hash(availabilities[listing.id])
+        ]
+
+    @classmethod
+    def save_exported_availabilities(cls, listings, availabilities):
+        """
+        Save the snapshot of the availabilities exported for the listings.
+
+        The snapshot is written with SQL, grouped by availability, so that
+        the listings are not logged again as changed in the inventory change
+        log.
+
+        :param listings: List of active records of listings
+        :param availabilities: Dictionary of listing id and its availability
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        ids_by_availability = defaultdict(list)
+        for listing in listings:
+            availability = availabilities[listing.id]
+            ids_by_availability[freeze(availability)].append(listing.id)
+
+        for listing_ids in ids_by_availability.itervalues():
+            availability = availabilities[listing_ids[0]]
+            for sub_ids in grouped_slice(listing_ids):
+                cursor.execute(*table.update(
+                    columns=[
+                        table.last_exported_availability_type,
+                        table.last_exported_availability,
+                        table.last_exported_quantity,
+                        table.last_exported_availability_hash,
+                    ],
+                    values=[
+                        availability['type'],
+                        availability.get('value'),
+                        availability.get('quantity'),
+                        cls.get_availability_hash(availability),
+                    ],
+                    where=table.id.in_(list(sub_ids))
+                ))
+
+        # Clean cursor cache as the records are updated with SQL
+        for cache in cursor.cache.itervalues():
+            if cls.__name__ in cache:
+                for listing in listings:
+                    cache[cls.__name__].pop(listing.id, None)
+
+    @classmethod
+    def iter_export_chunks(cls, listing_ids, chunk_size=None):
+        """
+        Yield the listings in chunks along with their availabilities computed
+        for the whole chunk. Each chunk is read separately so that the memory
+        used does not grow with the number of listings.
+
+        The chunk size defaults to the `inventory_export_chunk_size` option
+        of the `sale_channel` section of the trytond configuration (500).
+
+        :param listing_ids: List of ids of listings
+        :param chunk_size: Number of listings per chunk
+        :return: Generator of tuples of list of active records of listings
+                 and dictionary of listing id and availability
+        """
+        if chunk_size is None:
+            chunk_size = config.getint(
+                'sale_channel', 'inventory_export_chunk_size', default=500
+            )
+        for sub_ids in grouped_slice(listing_ids, chunk_size):
+            chunk = cls.browse(list(sub_ids))
+            yield chunk, cls.get_availabilities(chunk)
+
+    @classmethod
+    def export_inventory_chunk(cls, listings, availabilities):
+        """
+        Export listing.product inventory of a chunk of listings to
+        listing.channel
+
         Since external channels are implemented by downstream modules, it is
         the responsibility of those channels to implement bulk exporting for
-        respective channels.
+        respective channels, typically with one call to the channel per chunk.
         Default behaviour is to export inventory individually.
+
+        :param listings: List of active records of listings
+        :param availabilities: Dictionary of listing id and its availability
         """
         for listing in listings:
             listing.export_inventory()
@@ -285,3 +479,66 @@ class ProductSaleChannelListing(ModelSQL, ModelView):
             else:
                 rv['value'] = 'out_of_stock'
             return rv
+
+    # Tells whether get_availability is overridden by a downstream module
+    _default_get_availability = get_availability
+
+    @classmethod
+    def get_availabilities(cls, listings):
+        """
+        Return the availability of the products for the given listings.
+
+        When a downstream module overrides `get_availability`, it is called
+        for each listing. Otherwise the availabilities are computed in bulk
+        by `compute_availabilities`. Downstream modules able to compute
+        their availabilities in bulk should override this method too.
+
+        :param listings: List of active records of listings
+        :return: Dictionary of listing id and its availability
+        """
+        if cls.get_availability.im_func is not \
+                cls._default_get_availability.im_func:
+            return dict(
+                (listing.id, listing.get_availability())
+                for listing in listings
+            )
+        return cls.compute_availabilities(listings)
+
+    @classmethod
+    def compute_availabilities(cls, listings):
+        """
+        Compute the availability of the products for the given listings the
+        way `get_availability` does, in bulk.
+
+        Listings are grouped by their availability context and the stock
+        quantity is computed once for each group.
+
+        :param listings: List of active records of listings
+        :return: Dictionary of listing id and its availability
+        """
+        Product = Pool().get('product.product')
+
+        listings_by_context = defaultdict(list)
+        for listing in listings:
+            context = listing.get_availability_context()
+            listings_by_context[freeze(context)].append((listing, context))
+
+        res = {}
+        for group in listings_by_context.itervalues():
+            context = group[0][1]
+            product_ids = list(set(
+                listing.product.id for listing, _ in group
+            ))
+            with Transaction().set_context(**context):
+                quantities = Product.get_quantity(
+                    Product.browse(product_ids), 'quantity'
+                )
+            for listing, _ in group:
+                rv = {'type': 'bucket'}
+                rv['quantity'] = quantities[listing.product.id]
+                if rv['quantity'] > 0:
+                    rv['value'] = 'in_stock'
+                else:
+                    rv['value'] = 'out_of_stock'
+                res[listing.id] = rv
+        return res
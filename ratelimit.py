@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+    ratelimit.py
+
+"""
+import time
+from contextlib import contextmanager
+
+from sql import For, Literal
+from sql.aggregate import Count
+from sql.functions import CurrentTimestamp
+
+from trytond import backend
+from trytond.config import config
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['ChannelRateLimit', 'ChannelRateLimitLease']
+
+
+class ChannelRateLimit(ModelSQL):
+    """
+    Sale Channel Rate Limit
+
+    The state of the token bucket limiting the calls made to a channel. The
+    state is kept in the database so that it is shared by all the workers
+    and processes calling the channel. It is updated in separate short
+    transactions with the row locked.
+
+    Each call takes a token from the bucket, which is refilled at the rate
+    of the channel (`rate_limit` calls per second) up to `rate_limit_burst`
+    tokens. At most `rate_limit_concurrency` calls can be running at the
+    same time, each running call holding a lease in
+    `sale.channel.rate_limit.lease`.
+    """
+    __name__ = 'sale.channel.rate_limit'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, select=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    tokens = fields.Float('Tokens', readonly=True)
+    # Seconds since the epoch, DateTime fields are not precise enough
+    updated = fields.Float('Updated', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ChannelRateLimit, cls).__setup__()
+        cls._sql_constraints += [
+            ('unique_channel', 'UNIQUE(channel)',
+             'Only one rate limit per channel is allowed'),
+        ]
+
+    @staticmethod
+    def take(state, now, rate, burst):
+        """
+        Try to take a token from the bucket
+
+        :param state: Dictionary of tokens and updated
+        :param now: Current time in seconds since the epoch
+        :param rate: Number of calls per second, no limit if empty
+        :param burst: Maximum number of tokens in the bucket
+        :return: Tuple of the new state and the number of seconds to wait
+                 before trying again, which is 0 if the token is taken
+        """
+        if not rate:
+            return state, 0
+        burst = max(burst or 1, 1)
+        tokens = min(
+            burst,
+            state['tokens'] + max(now - state['updated'], 0) * rate
+        )
+        if tokens < 1:
+            return {'tokens': tokens, 'updated': now}, (1 - tokens) / rate
+        return {'tokens': tokens - 1, 'updated': now}, 0
+
+    @classmethod
+    def _take(cls, channel):
+        """
+        Try to take a token and, if the concurrency of the channel is
+        limited, a lease for a call to the channel in the current
+        transaction. The bucket of the channel is locked until the end of
+        the transaction.
+
+        The bucket is created by the first call to the channel. When two
+        first calls run concurrently, one of them fails on the unique
+        constraint and must be retried.
+
+        :return: Tuple of the number of seconds to wait before trying again,
+                 which is 0 if the call can be made, and the id of the lease
+                 taken if any
+        """
+        Lease = Pool().get('sale.channel.rate_limit.lease')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        lease = Lease.__table__()
+        now = time.time()
+
+        query = table.select(
+            table.id, table.tokens, table.updated,
+            where=table.channel == channel.id
+        )
+        if backend.name() == 'postgresql':
+            query.for_ = For('UPDATE')
+        cursor.execute(*query)
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute(*table.insert(
+                columns=[
+                    table.channel, table.tokens, table.updated,
+                    table.create_uid, table.create_date,
+                ],
+                values=[[
+                    channel.id, max(channel.rate_limit_burst or 1, 1), now,
+                    Transaction().user, CurrentTimestamp(),
+                ]]
+            ))
+            cursor.execute(*query)
+            row = cursor.fetchone()
+        rate_limit_id, tokens, updated = row
+
+        concurrency = channel.rate_limit_concurrency
+        if concurrency:
+            # Leases which were not released before they expired are calls
+            # which were lost
+            cursor.execute(*lease.delete(
+                where=(lease.rate_limit == rate_limit_id) &
+                (lease.expires < now)
+            ))
+            cursor.execute(*lease.select(
+                Count(Literal('*')), where=lease.rate_limit == rate_limit_id
+            ))
+            running, = cursor.fetchone()
+            if running >= concurrency:
+                return 0.1, None
+
+        state, wait = cls.take({
+            'tokens': tokens, 'updated': updated,
+        }, now, channel.rate_limit, channel.rate_limit_burst)
+        cursor.execute(*table.update(
+            columns=[table.tokens, table.updated],
+            values=[state['tokens'], state['updated']],
+            where=table.id == rate_limit_id
+        ))
+        if wait or not concurrency:
+            return wait, None
+
+        timeout = config.getfloat(
+            'sale_channel', 'rate_limit_lease_timeout', default=300
+        )
+        new_lease, = Lease.create([{
+            'rate_limit': rate_limit_id,
+            'expires': now + timeout,
+        }])
+        return 0, new_lease.id
+
+    @classmethod
+    def acquire(cls, channel):
+        """
+        Wait until a call can be made to the channel
+
+        :return: ID of the lease of the call, to release once it is finished,
+                 None if the concurrency of the channel is not limited
+        """
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+
+        while True:
+            try:
+                with Transaction().new_cursor() as txn:
+                    wait, lease_id = cls._take(channel)
+                    txn.cursor.commit()
+            except DatabaseIntegrityError:
+                # The bucket was created meanwhile by another call
+                continue
+            if not wait:
+                return lease_id
+            time.sleep(wait)
+
+    @classmethod
+    def release(cls, lease_id):
+        """
+        Mark a call to the channel as finished
+
+        :param lease_id: ID of the lease returned by `acquire`
+        """
+        Lease = Pool().get('sale.channel.rate_limit.lease')
+        table = Lease.__table__()
+
+        if lease_id is None:
+            return
+        with Transaction().new_cursor() as txn:
+            txn.cursor.execute(*table.delete(where=table.id == lease_id))
+            txn.cursor.commit()
+
+    @classmethod
+    @contextmanager
+    def limit(cls, channel):
+        """
+        Context manager wrapping a call to the channel with the rate limit
+        and the concurrency limit of the channel. Nothing is done when the
+        channel has neither.
+        """
+        if not channel.rate_limit and not channel.rate_limit_concurrency:
+            yield
+            return
+        lease_id = cls.acquire(channel)
+        try:
+            yield
+        finally:
+            cls.release(lease_id)
+
+
+class ChannelRateLimitLease(ModelSQL):
+    """
+    Sale Channel Rate Limit Lease
+
+    A lease is held by each running call to a channel whose concurrency is
+    limited. A lease which is not released before it expires, after
+    `rate_limit_lease_timeout` seconds (`sale_channel` section of the
+    trytond configuration, default 300), is considered lost and is deleted
+    by the next call.
+    """
+    __name__ = 'sale.channel.rate_limit.lease'
+
+    rate_limit = fields.Many2One(
+        'sale.channel.rate_limit', 'Rate Limit', required=True, select=True,
+        readonly=True, ondelete='CASCADE'
+    )
+    # Seconds since the epoch
+    expires = fields.Float('Expires', required=True, readonly=True)
@@ -3,15 +3,46 @@
     sale
 
 """
+from collections import defaultdict
+from datetime import date
+
+from sql.aggregate import Count
+from sql.operators import Exists, Not
+
 from trytond.model import fields
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Or, Bool
+from trytond.tools import grouped_slice
 
 __all__ = ['Sale', 'SaleLine']
 __metaclass__ = PoolMeta
 
 
+def get_duplicate_channel_identifiers(model, records):
+    """
+    Return the sorted channel identifiers of the records which are used by
+    more than one record of the model. The records are checked with a single
+    query per slice of identifiers.
+    """
+    table = model.__table__()
+    cursor = Transaction().cursor
+
+    identifiers = set(
+        r.channel_identifier for r in records if r.channel_identifier
+    )
+    duplicates = []
+    for sub_identifiers in grouped_slice(identifiers):
+        cursor.execute(*table.select(
+            table.channel_identifier,
+            where=table.channel_identifier.in_(list(sub_identifiers)),
+            group_by=table.channel_identifier,
+            having=Count(table.id) > 1
+        ))
+        duplicates.extend(identifier for identifier, in cursor.fetchall())
+    return sorted(duplicates)
+
+
 class Sale:
     __name__ = 'sale.sale'
 
@@ -47,44 +78,64 @@ class Sale:
     )
 
     # XXX: to identify sale order in external channel
-    channel_identifier = fields.Char('Channel Identifier', readonly=True)
+    channel_identifier = fields.Char(
+        'Channel Identifier', readonly=True, select=True
+    )
+
+    #: Set on imported sales whose shipments are assigned later by
+    #: `assign_pending_shipments`
+    shipment_assignment_pending = fields.Boolean(
+        'Shipment Assignment Pending', readonly=True, select=True
+    )
 
     @classmethod
     def validate(cls, sales):
         super(Sale, cls).validate(sales)
-        for sale in sales:
-            sale.check_channel_identifier()
+        cls.check_channel_identifiers(sales)
+
+    @classmethod
+    def check_channel_identifiers(cls, sales):
+        """
+        Make sure sales have no duplicate channel identifier. All the
+        duplicates are reported at once.
+        """
+        duplicates = get_duplicate_channel_identifiers(cls, sales)
+        if duplicates:
+            cls.raise_user_error('duplicate_order', ('", "'.join(duplicates),))
 
     def check_channel_identifier(self):
         """
         Make sure sale has no duplicate channel identifier
         """
-        if self.channel_identifier and self.search([
-            ('channel_identifier', '=', self.channel_identifier),
-            ('id', '!=', self.id),
-        ]):
-            self.raise_user_error('duplicate_order', (self.channel_identifier,))
+        self.check_channel_identifiers([self])
 
     @classmethod
     def search_has_channel_exception(cls, name, clause):
         """
         Returns domain for sale with exceptions
         """
-        if clause[2]:
-            return [('exceptions.is_resolved', '=', False)]
-        else:
-            return [
-                'OR',
-                [('exceptions', '=', None)],
-                [('exceptions.is_resolved', '=', True)],
-            ]
+        ChannelException = Pool().get('channel.exception')
+        sale = cls.__table__()
+        exception = ChannelException.__table__()
+
+        unresolved = Exists(exception.select(
+            exception.id,
+            where=(exception.origin_model == cls.__name__) &
+            (exception.origin_id == sale.id) &
+            (exception.channel == sale.channel) &
+            ~exception.is_resolved
+        ))
+        if not clause[2]:
+            unresolved = Not(unresolved)
+        return [('id', 'in', sale.select(sale.id, where=unresolved))]
 
     def get_channel_exceptions(self, name=None):
         ChannelException = Pool().get('channel.exception')
 
         return map(
             int, ChannelException.search([
-                ('origin', '=', '%s,%s' % (self.__name__, self.id)),
+                ('origin_model', '=', self.__name__),
+                ('origin_id', '=', self.id),
                 ('channel', '=', self.channel.id),
             ], order=[('is_resolved', 'desc')])
         )
@@ -93,19 +144,31 @@ class Sale:
     def set_channel_exceptions(cls, exceptions, name, value):
         pass
 
-    def get_has_channel_exception(self, name):
+    @classmethod
+    def get_has_channel_exception(cls, sales, name):
         """
-        Returs True if sale has exception
+        Returs True for the sales which have unresolved exceptions. The
+        exceptions of all the sales are looked up with one query per slice
+        of sales.
         """
         ChannelException = Pool().get('channel.exception')
-
-        return bool(
-            ChannelException.search([
-                ('origin', '=', '%s,%s' % (self.__name__, self.id)),
-                ('channel', '=', self.channel.id),
-                ('is_resolved', '=', False)
-            ])
-        )
+        exception = ChannelException.__table__()
+        cursor = Transaction().cursor
+
+        result = dict((sale.id, False) for sale in sales)
+        channels = dict((sale.id, sale.channel.id) for sale in sales)
+        for sub_ids in grouped_slice(channels.keys()):
+            cursor.execute(*exception.select(
+                exception.origin_id, exception.channel,
+                where=(exception.origin_model == cls.__name__) &
+                exception.origin_id.in_(list(sub_ids)) &
+                ~exception.is_resolved,
+                group_by=[exception.origin_id, exception.channel]
+            ))
+            for sale_id, channel_id in cursor.fetchall():
+                if channels[sale_id] == channel_id:
+                    result[sale_id] = True
+        return result
 
     @classmethod
     def __setup__(cls):
@@ -132,11 +195,11 @@ class Sale:
     def default_channel(cls):
         User = Pool().get('res.user')
 
-        user = User(Transaction().user)
         channel_id = Transaction().context.get('current_channel')
 
         if channel_id:
             return channel_id
+        user = User(Transaction().user)  # pragma: nocover
         return user.current_channel and \
             user.current_channel.id  # pragma: nocover
 
@@ -147,7 +210,7 @@ class Sale:
 
         channel_id = Sale.default_channel()
         if channel_id:
-            return Channel(channel_id).company.id
+            return Channel.get_sale_defaults(channel_id)['company']
 
         return Transaction().context.get('company')  # pragma: nocover
 
@@ -162,7 +225,7 @@ class Sale:
             config = Config(1)
             return config.sale_invoice_method
 
-        return Channel(channel_id).invoice_method
+        return Channel.get_sale_defaults(channel_id)['invoice_method']
 
     @staticmethod
     def default_shipment_method():
@@ -175,7 +238,7 @@ class Sale:
             config = Config(1)
             return config.sale_invoice_method
 
-        return Channel(channel_id).shipment_method
+        return Channel.get_sale_defaults(channel_id)['shipment_method']
 
     @staticmethod
     def default_warehouse():
@@ -187,7 +250,7 @@ class Sale:
         if not channel_id:  # pragma: nocover
             return Location.search([('type', '=', 'warehouse')], limit=1)[0].id
         else:
-            return Channel(channel_id).warehouse.id
+            return Channel.get_sale_defaults(channel_id)['warehouse']
 
     @staticmethod
     def default_price_list():
@@ -196,7 +259,7 @@ class Sale:
 
         channel_id = Sale.default_channel()
         if channel_id:
-            return Channel(channel_id).price_list.id
+            return Channel.get_sale_defaults(channel_id)['price_list']
         return None  # pragma: nocover
 
     @staticmethod
@@ -206,24 +269,24 @@ class Sale:
 
         channel_id = Sale.default_channel()
         if channel_id:
-            return Channel(channel_id).payment_term.id
+            return Channel.get_sale_defaults(channel_id)['payment_term']
         return None  # pragma: nocover
 
     @fields.depends('channel', 'party')
     def on_change_channel(self):
+        Channel = Pool().get('sale.channel')
+
         if not self.channel:
             return {}  # pragma: nocover
+        defaults = Channel.get_sale_defaults(self.channel.id)
         res = {}
-        for fname in ('company', 'warehouse', 'currency', 'payment_term'):
-            fvalue = getattr(self.channel, fname)
-            if fvalue:
-                res[fname] = fvalue.id
+        for fname in (
+                'company', 'warehouse', 'currency', 'payment_term',
+                'invoice_method', 'shipment_method'):
+            if defaults[fname]:
+                res[fname] = defaults[fname]
         if (not self.party or not self.party.sale_price_list):
-            res['price_list'] = self.channel.price_list.id  # pragma: nocover
-        if self.channel.invoice_method:
-            res['invoice_method'] = self.channel.invoice_method
-        if self.channel.shipment_method:
-            res['shipment_method'] = self.channel.shipment_method
+            res['price_list'] = defaults['price_list']  # pragma: nocover
 
         # Update AR record
         for key, value in res.iteritems():
@@ -317,17 +380,90 @@ class Sale:
                 default['channel'] = cls.default_channel()
 
         default['channel_identifier'] = None
+        default['shipment_assignment_pending'] = False
 
         return super(Sale, cls).copy(sales, default=default)
 
     @classmethod
     def confirm(cls, sales):
         "Validate sale before confirming"
+        has_exception = cls.get_has_channel_exception(
+            sales, 'has_channel_exception'
+        )
         for sale in sales:
-            if sale.has_channel_exception:
+            if has_exception[sale.id]:
                 cls.raise_user_error('channel_exception', sale.reference)
         super(Sale, cls).confirm(sales)
 
+    @classmethod
+    def process_to_channel_states(cls, sale_states):
+        """
+        Process the sales in tryton based on the state of the orders when
+        they are imported from channel.
+
+        Sales are grouped by the tryton action of their channel state and
+        each step of the workflow (quote, confirm, process, wait and assign
+        of the shipments) is run once for all the sales of a group.
+
+        :param sale_states: List of tuples of sale active record and the
+                            state on external channel it was imported in.
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        by_action = defaultdict(list)
+        by_methods = defaultdict(list)
+        for sale, channel_state in sale_states:
+            data = sale.channel.get_tryton_action(channel_state)
+            by_action[data['action']].append(sale)
+            by_methods[
+                (data['invoice_method'], data['shipment_method'])
+            ].append(sale)
+
+        for (invoice_method, shipment_method), sales in \
+                by_methods.iteritems():
+            cls.write(sales, {
+                'invoice_method': invoice_method,
+                'shipment_method': shipment_method,
+            })
+
+        to_confirm = cls.browse(map(int, (
+            by_action['process_manually'] +
+            by_action['process_automatically']
+        )))
+        if to_confirm:
+            cls.quote(to_confirm)
+            cls.confirm(to_confirm)
+
+        to_process = cls.browse(map(int, by_action['process_automatically']))
+        if to_process:
+            cls.process(to_process)
+            shipments = [
+                shipment.id for sale in cls.browse(map(int, to_process))
+                for shipment in sale.shipments
+            ]
+            Shipment.wait([
+                s for s in Shipment.browse(shipments) if s.state == 'draft'
+            ])
+
+            # Shipments of channels deferring the assignment are assigned
+            # later by assign_pending_shipments
+            deferred = [
+                sale for sale in to_process
+                if sale.channel.defer_shipment_assignment
+            ]
+            if deferred:
+                cls.write(deferred, {'shipment_assignment_pending': True})
+            cls.assign_shipments([
+                shipment for sale in to_process
+                if not sale.channel.defer_shipment_assignment
+                for shipment in Shipment.browse(map(int, sale.shipments))
+                if shipment.state == 'waiting'
+            ])
+
+        if by_action['import_as_past']:
+            # XXX: mark past orders as completed
+            cls.write(by_action['import_as_past'], {'state': 'done'})
+
     def process_to_channel_state(self, channel_state):
         """
         Process the sale in tryton based on the state of order
@@ -335,31 +471,68 @@ class Sale:
 
         :param channel_state: State on external channel the order was imported.
         """
-        Sale = Pool().get('sale.sale')
-        Shipment = Pool().get('stock.shipment.out')
+        self.process_to_channel_states([(self, channel_state)])
 
-        data = self.channel.get_tryton_action(channel_state)
+    @classmethod
+    def assign_shipments(cls, shipments):
+        """
+        Try to assign the waiting customer shipments of channel sales, one
+        after the other in the order given, with `assign_try` of the
+        shipments.
 
-        self.invoice_method = data['invoice_method']
-        self.shipment_method = data['shipment_method']
-        self.save()
+        :param shipments: List of active records of waiting shipments
+        :return: List of active records of the shipments assigned
+        """
+        Shipment = Pool().get('stock.shipment.out')
 
-        if data['action'] in ['process_manually', 'process_automatically']:
-            Sale.quote([self])
-            Sale.confirm([self])
+        return [
+            shipment for shipment in shipments
+            if Shipment.assign_try([shipment])
+        ]
 
-        if data['action'] == 'process_automatically':
-            Sale.process([self])
-            for shipment in self.shipments:
-                if shipment.state == 'draft':
-                    Shipment.wait([shipment])
-                if shipment.state == 'waiting':
-                    Shipment.assign_try([shipment])
+    @classmethod
+    def assign_pending_shipments(cls):
+        """
+        Try to assign the waiting shipments of the sales flagged by
+        `process_to_channel_states`. The shipments are assigned warehouse by
+        warehouse, ordered by planned date so that the oldest orders get the
+        stock first. The sales are unflagged once tried, like the assignment
+        done at import, shipments left waiting are handled by the usual stock
+        tools.
+
+        The shipments are assigned as root: the user running the cron is not
+        allowed to read the channels of the sales nor the shipments of their
+        companies.
+
+        :return: List of active records of the shipments assigned
+        """
+        with Transaction().set_user(0):
+            sales = cls.search([('shipment_assignment_pending', '=', True)])
+
+            by_warehouse = defaultdict(list)
+            for sale in sales:
+                for shipment in sale.shipments:
+                    if shipment.state == 'waiting':
+                        by_warehouse[shipment.warehouse.id].append(shipment)
+
+            assigned = []
+            for warehouse_id in sorted(by_warehouse):
+                shipments = sorted(
+                    set(by_warehouse[warehouse_id]),
+                    key=lambda s: (s.planned_date or date.max, s.id)
+                )
+                assigned.extend(cls.assign_shipments(shipments))
+
+            if sales:
+                cls.write(sales, {'shipment_assignment_pending': False})
+        return assigned
 
-        if data['action'] == 'import_as_past':
-            # XXX: mark past orders as completed
-            self.state = 'done'
-            self.save()
+    @classmethod
+    def assign_pending_shipments_using_cron(cls):  # pragma: nocover
+        """
+        Cron method to assign the pending shipments of imported sales
+        """
+        cls.assign_pending_shipments()
 
 
 class SaleLine:
@@ -367,7 +540,9 @@ class SaleLine:
     __name__ = 'sale.line'
 
     # XXX: to identify sale order item in external channel
-    channel_identifier = fields.Char('Channel Identifier', readonly=True)
+    channel_identifier = fields.Char(
+        'Channel Identifier', readonly=True, select=True
+    )
 
     @classmethod
     def __setup__(cls):
@@ -395,17 +570,22 @@ class SaleLine:
     @classmethod
     def validate(cls, lines):
         super(SaleLine, cls).validate(lines)
-        for line in lines:
-            line.check_channel_identifier()
+        cls.check_channel_identifiers(lines)
+
+    @classmethod
+    def check_channel_identifiers(cls, lines):
+        """
+        Make sure sale lines have no duplicate channel identifier. All the
+        duplicates are reported at once.
+        """
+        duplicates = get_duplicate_channel_identifiers(cls, lines)
+        if duplicates:
+            cls.raise_user_error(
+                'duplicate_order_line', ('", "'.join(duplicates),)
+            )
 
     def check_channel_identifier(self):
         """
         Make sure sale line has no duplicate channel identifier
         """
-        if self.channel_identifier and self.search([
-            ('channel_identifier', '=', self.channel_identifier),
-            ('id', '!=', self.id),
-        ]):
-            self.raise_user_error(
-                'duplicate_order_line', (self.channel_identifier,)
-            )
+        self.check_channel_identifiers([self])
@@ -70,6 +70,65 @@ class PostgresTest(Command):
         sys.exit(-1)
 
 
+class SQLiteBenchmark(Command):
+    """
+    Run the benchmarks on SQLite
+    """
+    description = "Run benchmarks on SQLite"
+
+    user_options = [
+        ('channels=', None, "Number of channels"),
+        ('products=', None, "Number of products listed on each channel"),
+        ('moves=', None, "Number of stock moves"),
+        ('changes=', None, "Number of inventory changes logged"),
+        ('sales=', None, "Number of sales"),
+        ('exceptions=', None, "Number of channel exceptions"),
+        ('repeat=', None, "Number of runs of each benchmark"),
+        ('output=', None, "File to write the results to"),
+        ('compare=', None, "Results file of a previous run to compare with"),
+    ]
+    database_uri = 'sqlite://'
+
+    def initialize_options(self):
+        for option, _, _ in self.user_options:
+            setattr(self, option.rstrip('='), None)
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        if self.distribution.tests_require:
+            self.distribution.fetch_build_eggs(self.distribution.tests_require)
+
+        os.environ['TRYTOND_DATABASE_URI'] = self.database_uri
+        if self.database_uri == 'sqlite://':
+            os.environ['DB_NAME'] = ':memory:'
+        else:
+            os.environ['DB_NAME'] = 'benchmark_' + str(int(time.time()))
+        for option, _, _ in self.user_options:
+            option = option.rstrip('=')
+            if getattr(self, option) is not None:
+                os.environ['BENCHMARK_' + option.upper()] = getattr(
+                    self, option
+                )
+
+        from tests.benchmark_sale_channel import suite
+        test_result = unittest.TextTestRunner(verbosity=3).run(suite())
+
+        if test_result.wasSuccessful():
+            sys.exit(0)
+        sys.exit(-1)
+
+
+class PostgresBenchmark(SQLiteBenchmark):
+    """
+    Run the benchmarks on Postgres.
+    """
+    description = "Run benchmarks on Postgresql"
+
+    database_uri = 'postgresql://'
+
+
 config = ConfigParser.ConfigParser()
 config.readfp(open('tryton.cfg'))
 info = dict(config.items('tryton'))
@@ -146,5 +205,7 @@ setup(
     cmdclass={
         'test': SQLiteTest,
         'test_on_postgres': PostgresTest,
+        'benchmark': SQLiteBenchmark,
+        'benchmark_on_postgres': PostgresBenchmark,
     }
 )
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+    stock.py
+
+"""
+from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
+from trytond import backend
+
+__metaclass__ = PoolMeta
+__all__ = ['StockMove']
+
+
+class StockMove:
+    "Stock Move"
+    __name__ = 'stock.move'
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(StockMove, cls).__register__(module_name)
+
+        # Indexes used to find listings whose inventory changed when the
+        # inventory change log is bypassed
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action('create_date', action='add')
+        table.index_action('write_date', action='add')
+
+    @classmethod
+    def create(cls, vlist):
+        """
+        Log inventory changes for listings of the products moved
+        """
+        InventoryChange = Pool().get('sale.channel.inventory_change')
+
+        moves = super(StockMove, cls).create(vlist)
+        InventoryChange.log_products([m.product.id for m in moves])
+        return moves
+
+    @classmethod
+    def write(cls, moves, values, *args):
+        """
+        Log inventory changes for listings of the products moved
+        """
+        InventoryChange = Pool().get('sale.channel.inventory_change')
+
+        all_moves = []
+        actions = iter((moves, values) + args)
+        for records, _ in zip(actions, actions):
+            all_moves.extend(records)
+
+        # Products are collected before and after the write as the product
+        # of a move could be changed
+        product_ids = set(m.product.id for m in all_moves)
+        super(StockMove, cls).write(moves, values, *args)
+        all_moves = cls.browse(map(int, all_moves))
+        product_ids.update(m.product.id for m in all_moves)
+
+        InventoryChange.log_products(product_ids)
+
+    @classmethod
+    def delete(cls, moves):
+        """
+        Log inventory changes for listings of the products moved
+        """
+        InventoryChange = Pool().get('sale.channel.inventory_change')
+
+        InventoryChange.log_products([m.product.id for m in moves])
+        super(StockMove, cls).delete(moves)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+    synclog.py
+
+"""
+import time
+from datetime import datetime
+from contextlib import contextmanager
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+
+__all__ = ['ChannelSyncLog']
+
+
+class ChannelSyncLog(ModelSQL, ModelView):
+    """
+    Sale Channel Sync Log
+
+    A sync log records how long a run of an import or export operation of a
+    channel took, the number of queries it executed on its transaction, the
+    number of records it processed and how it ended. Runs of cron methods
+    and channel jobs are logged.
+    """
+    __name__ = 'sale.channel.sync_log'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, select=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    operation = fields.Char(
+        'Operation', required=True, select=True, readonly=True
+    )
+    started_at = fields.DateTime('Started At', readonly=True)
+    duration = fields.Float('Duration (s)', digits=(16, 3), readonly=True)
+    queries = fields.Integer('Queries', readonly=True)
+    records = fields.Integer('Records', readonly=True)
+    state = fields.Selection([
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, select=True, readonly=True)
+    message = fields.Text('Message', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ChannelSyncLog, cls).__setup__()
+        cls._order.insert(0, ('started_at', 'DESC'))
+
+    @classmethod
+    @contextmanager
+    def measure(cls, stats=None):
+        """
+        Context manager measuring the time spent and the number of queries
+        executed on the cursor of the current transaction. Queries executed
+        in separate transactions are not counted.
+
+        :param stats: Optional dictionary to fill, a new one is created if
+                      not given
+        :return: The dictionary of statistics, with `started_at`, `duration`
+                 and `queries` set when the context manager exits. The caller
+                 can set the number of `records` processed.
+        """
+        if stats is None:
+            stats = {}
+        cursor = Transaction().cursor
+        # The counter of an enclosing measure if any
+        previous = vars(cursor).get('execute')
+        execute = cursor.execute
+        counter = [0]
+
+        def counting_execute(*args, **kwargs):
+            counter[0] += 1
+            return execute(*args, **kwargs)
+
+        stats['started_at'] = datetime.utcnow()
+        start = time.time()
+        cursor.execute = counting_execute
+        try:
+            yield stats
+        finally:
+            if previous is None:
+                del cursor.execute
+            else:
+                cursor.execute = previous
+            stats['duration'] = time.time() - start
+            stats['queries'] = counter[0]
+
+    @staticmethod
+    def count_records(result):
+        """
+        Return the number of records processed by an operation from the
+        value it returned, None if unknown
+        """
+        if isinstance(result, (list, tuple)):
+            return len(result)
+
+    @classmethod
+    def log(cls, channel_id, operation, result, stats):
+        """
+        Record a run of an operation in a separate transaction, so that runs
+        which failed and are rolled back are logged too.
+
+        :param channel_id: ID of the channel
+        :param operation: Name of the method of the channel which was run
+        :param result: Tuple of the state (`done` or `failed`) and the
+                       message of the run
+        :param stats: Dictionary of statistics filled by `measure`
+        """
+        state, message = result
+        with Transaction().new_cursor() as txn:
+            cls.create([{
+                'channel': channel_id,
+                'operation': operation,
+                'started_at': stats.get('started_at'),
+                'duration': round(stats.get('duration') or 0, 3),
+                'queries': stats.get('queries'),
+                'records': stats.get('records'),
+                'state': state,
+                'message': message or None,
+            }])
+            txn.cursor.commit()
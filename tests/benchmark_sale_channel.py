@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/benchmark_sale_channel.py
+
+    Benchmarks of the hot paths of sale channels. They are not part of the
+    test suite and are run with::
+
+        python setup.py benchmark
+        python setup.py benchmark_on_postgres
+
+    The amount of data seeded is read from the environment (see `SIZES`) and
+    the timings are written as JSON to `BENCHMARK_OUTPUT`, so that the results
+    of two versions can be compared with `BENCHMARK_COMPARE`.
+"""
+import os
+import sys
+import json
+import time
+import unittest
+import ConfigParser
+from decimal import Decimal
+from datetime import datetime
+
+import trytond.tests.test_tryton
+from trytond import backend
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+
+from tests.test_sale_channel import BaseTestCase
+
+# Environment variable and default value of the amount of data to seed
+SIZES = [
+    ('channels', 'BENCHMARK_CHANNELS', 5),
+    ('products', 'BENCHMARK_PRODUCTS', 100),
+    ('moves', 'BENCHMARK_MOVES', 500),
+    ('changes', 'BENCHMARK_CHANGES', 100),
+    ('sales', 'BENCHMARK_SALES', 100),
+    ('exceptions', 'BENCHMARK_EXCEPTIONS', 100),
+]
+
+
+def get_sizes():
+    """
+    Return the amount of data to seed from the environment
+    """
+    return dict(
+        (name, int(os.environ.get(variable, default)))
+        for name, variable, default in SIZES
+    )
+
+
+def get_version():
+    """
+    Return the version of the module from tryton.cfg
+    """
+    config = ConfigParser.ConfigParser()
+    config.read(os.path.join(
+        os.path.dirname(__file__), '..', 'tryton.cfg'
+    ))
+    return config.get('tryton', 'version')
+
+
+def compare(results, previous):
+    """
+    Return lines comparing the timings of two benchmark results
+    """
+    lines = []
+    for name, timing in sorted(results['timings'].items()):
+        before = previous['timings'].get(name)
+        if before is None or not before['best']:
+            lines.append('%-40s %10.4fs' % (name, timing['best']))
+            continue
+        lines.append('%-40s %10.4fs %10.4fs %+7.1f%%' % (
+            name, before['best'], timing['best'],
+            (timing['best'] - before['best']) / before['best'] * 100
+        ))
+    return lines
+
+
+class BenchmarkSaleChannel(BaseTestCase):
+    """
+    Benchmark the hot paths of sale channels
+    """
+
+    def measure(self, name, function, repeat=None):
+        """
+        Time the function and record the best and average time
+
+        :param name: Name of the timing in the results
+        :param function: Function called without arguments
+        :param repeat: Number of calls, BENCHMARK_REPEAT by default
+        """
+        if repeat is None:
+            repeat = int(os.environ.get('BENCHMARK_REPEAT', 3))
+
+        timings = []
+        for _ in xrange(repeat):
+            # Do not let the records cached by a run speed up the next one
+            Transaction().cursor.cache.clear()
+            start = time.time()
+            function()
+            timings.append(time.time() - start)
+        self.timings[name] = {
+            'best': min(timings),
+            'average': sum(timings) / len(timings),
+            'repeat': repeat,
+        }
+
+    def seed(self, sizes):
+        """
+        Create the channels, listings, stock moves, inventory changes, sales
+        and exceptions
+        """
+        Listing = POOL.get('product.product.channel_listing')
+        InventoryChange = POOL.get('sale.channel.inventory_change')
+        StockMove = POOL.get('stock.move')
+        ChannelException = POOL.get('channel.exception')
+        OrderState = POOL.get('sale.channel.order_state')
+
+        warehouse, = self.Location.search([('code', '=', 'WH')])
+        lost_and_found, = self.Location.search([('type', '=', 'lost_found')])
+
+        with Transaction().set_context(company=self.company.id):
+            self.channels = self.SaleChannel.create([{
+                'name': 'Benchmark %d' % index,
+                'code': 'B%d' % index,
+                'address': self.company_party.addresses[0].id,
+                'source': 'manual',
+                'warehouse': warehouse.id,
+                'invoice_method': 'manual',
+                'shipment_method': 'manual',
+                'payment_term': self.payment_term.id,
+                'price_list': self.price_list,
+                'read_users': [('add', [self.sales_user.id])],
+                'create_users': [('add', [self.sales_user.id])],
+            } for index in xrange(sizes['channels'])])
+        for channel in self.channels:
+            self.set_channel_source(channel, 'dummy')
+
+        templates = self._create_product_template('benchmark', [{
+            'type': 'goods',
+            'salable': True,
+            'list_price': Decimal('10'),
+            'cost_price': Decimal('5'),
+            'account_expense': self._get_account_by_kind('expense').id,
+            'account_revenue': self._get_account_by_kind('revenue').id,
+        } for _ in xrange(sizes['products'])], uri='benchmark')
+        self.products = [t.products[0] for t in templates]
+
+        self.listings = Listing.create([{
+            'channel': channel.id,
+            'product': product.id,
+            'product_identifier': 'product-%d' % product.id,
+        } for channel in self.channels for product in self.products])
+
+        with Transaction().set_context(company=self.company.id):
+            StockMove.create([{
+                'from_location': lost_and_found.id,
+                'to_location': warehouse.storage_location.id,
+                'quantity': 10,
+                'product': product.id,
+                'uom': product.default_uom.id,
+            } for product in (
+                self.products[i % len(self.products)]
+                for i in xrange(sizes['moves'])
+            )])
+
+        # Once the inventory is exported, the listings to export are read
+        # from the changes logged since
+        for channel in self.channels:
+            InventoryChange.delete_changes(sum(
+                InventoryChange.get_changes(channel).values(), []
+            ))
+        self.SaleChannel.write(self.channels, {
+            'last_inventory_export_time': datetime.utcnow(),
+        })
+        listing_ids = map(int, self.listings)
+        for start in xrange(0, sizes['changes'], len(listing_ids)):
+            InventoryChange.log_listings(
+                listing_ids[:sizes['changes'] - start]
+            )
+
+        OrderState.create([{
+            'channel': channel.id,
+            'name': 'Paid',
+            'code': 'paid',
+            'action': 'process_automatically',
+            'invoice_method': 'manual',
+            'shipment_method': 'order',
+        } for channel in self.channels])
+
+        with Transaction().set_context(company=self.company.id):
+            self.sales = self.Sale.create([{
+                'channel': channel.id,
+                'channel_identifier': 'order-%d' % index,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'currency': self.currency.id,
+                'payment_term': self.payment_term.id,
+                'sale_date': POOL.get('ir.date').today(),
+                'lines': [('create', [{
+                    'type': 'line',
+                    'product': product.id,
+                    'description': product.rec_name,
+                    'quantity': 1,
+                    'unit': product.default_uom.id,
+                    'unit_price': Decimal('10'),
+                    'channel_identifier': 'order-%d-1' % index,
+                }])],
+            } for index, channel, product in (
+                (i, self.channels[i % len(self.channels)],
+                    self.products[i % len(self.products)])
+                for i in xrange(sizes['sales'])
+            )])
+
+        ChannelException.create([{
+            'origin': 'sale.sale,%d' % sale.id,
+            'channel': sale.channel.id,
+            'log': 'Benchmark exception',
+            'is_resolved': bool(index % 2),
+        } for index, sale in (
+            (i, self.sales[i % len(self.sales)])
+            for i in xrange(sizes['exceptions'])
+        )])
+
+    def test_benchmark(self):
+        """
+        Seed the data and time the hot paths
+        """
+        Listing = POOL.get('product.product.channel_listing')
+
+        sizes = get_sizes()
+        self.timings = {}
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            start = time.time()
+            self.seed(sizes)
+            seed_time = time.time() - start
+
+            with Transaction().set_context(company=self.company.id):
+                self.measure('get_listings_to_export_inventory', lambda: [
+                    channel.get_listings_to_export_inventory()
+                    for channel in self.channels
+                ])
+                self.measure(
+                    'get_availability_fields',
+                    lambda: Listing.get_availability_fields(
+                        Listing.browse(self.listings),
+                        ['availability_type_used', 'availability_used',
+                            'quantity']
+                    )
+                )
+                self.measure(
+                    'sale_validate',
+                    lambda: self.Sale.validate(self.Sale.browse(self.sales))
+                )
+                self.measure(
+                    'get_has_channel_exception',
+                    lambda: self.Sale.get_has_channel_exception(
+                        self.Sale.browse(self.sales), 'has_channel_exception'
+                    )
+                )
+
+            def get_allowed_channels():
+                self.User.clear_allowed_channels_cache()
+                with Transaction().set_user(self.sales_user_id):
+                    user = self.User(self.sales_user_id)
+                    user.get_allowed_channels('allowed_read_channels')
+
+            self.measure('get_allowed_channels', get_allowed_channels)
+
+            # Sales are processed only once and sales with unresolved
+            # exceptions can not be confirmed
+            with Transaction().set_context(company=self.company.id):
+                sales = self.Sale.search([
+                    ('id', 'in', map(int, self.sales)),
+                    ('has_channel_exception', '=', False),
+                ])
+                self.measure(
+                    'process_to_channel_states',
+                    lambda: self.Sale.process_to_channel_states([
+                        (sale, 'paid') for sale in sales
+                    ]), repeat=1
+                )
+
+        results = {
+            'version': get_version(),
+            'backend': backend.name(),
+            'date': datetime.utcnow().isoformat(),
+            'sizes': sizes,
+            'seed': seed_time,
+            'timings': self.timings,
+        }
+        output = os.environ.get('BENCHMARK_OUTPUT') or \
+            'benchmark-%s-%s.json' % (results['version'], results['backend'])
+        with open(output, 'w') as result_file:
+            json.dump(results, result_file, indent=4, sort_keys=True)
+
+        previous = {'timings': {}}
+        if os.environ.get('BENCHMARK_COMPARE'):
+            with open(os.environ['BENCHMARK_COMPARE']) as previous_file:
+                previous = json.load(previous_file)
+        sys.stderr.write('\n%s\n' % '\n'.join(compare(results, previous)))
+        sys.stderr.write('Results written to %s\n' % output)
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(BenchmarkSaleChannel),
+    ])
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -5,14 +5,18 @@
 """
 import sys
 import os
+import time
+import threading
 import unittest
 from decimal import Decimal
-from contextlib import nested
+from datetime import datetime, timedelta
+from contextlib import nested, contextmanager
 
 import trytond.tests.test_tryton
+from trytond.config import config
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
 from trytond.exceptions import UserError
-from trytond.transaction import Transaction
+from trytond.transaction import Transaction, _CursorManager
 DIR = os.path.abspath(os.path.normpath(os.path.join(
     __file__, '..', '..', '..', '..', '..', 'trytond'
 )))
@@ -20,6 +24,77 @@ if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 
 
+@contextmanager
+def patch(obj, name, value):
+    """
+    Replace the attribute of the object for the duration of the block
+    """
+    missing = object()
+    previous = vars(obj).get(name, missing)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        if previous is missing:
+            delattr(obj, name)
+        else:
+            setattr(obj, name, previous)
+
+
+@contextmanager
+def sale_channel_config(**options):
+    """
+    Set options of the sale_channel section of the trytond configuration for
+    the duration of the block
+    """
+    if not config.has_section('sale_channel'):
+        config.add_section('sale_channel')
+    for name, value in options.iteritems():
+        config.set('sale_channel', name, str(value))
+    try:
+        yield
+    finally:
+        for name in options:
+            config.remove_option('sale_channel', name)
+
+
+class SharedCursor(object):
+    """
+    Cursor of a separate transaction run in the transaction of the test
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def shared_new_cursor(transaction, autocommit=False, readonly=False):
+    manager = _CursorManager(transaction.cursor)
+    transaction.cursor = SharedCursor(transaction.cursor)
+    return manager
+
+
+def inline_transactions():
+    """
+    Run the separate transactions started with `new_cursor` in the
+    transaction of the test. The cursors of the in memory database share
+    its connection, so they would commit or roll back the test data.
+    Commits and rollbacks of the separate transactions are ignored.
+    """
+    return patch(Transaction, 'new_cursor', shared_new_cursor)
+
+
 class BaseTestCase(unittest.TestCase):
     '''
     Base Test Case sale payment module.
@@ -322,6 +397,17 @@ class BaseTestCase(unittest.TestCase):
         # Save IDs to share between transactions
         self.sales_user_id = self.sales_user.id
 
+    def set_channel_source(self, channel, source):
+        """
+        Set the source of channel bypassing the selection validation, since
+        listings can only be created on non manual channels
+        """
+        channel_table = self.SaleChannel.__table__()
+        Transaction().cursor.execute(*channel_table.update(
+            [channel_table.source], [source],
+            where=channel_table.id == channel.id
+        ))
+
     def create_sale(self, res_user_id, channel=None):
         """
         Create sale in new transaction
@@ -554,6 +640,8 @@ class TestSaleChannel(BaseTestCase):
             }])
 
             self.assert_(channel_exception)
+            self.assertEqual(channel_exception.origin_model, 'sale.sale')
+            self.assertEqual(channel_exception.origin_id, sale.id)
 
             self.assertTrue(sale.has_channel_exception)
 
@@ -563,6 +651,19 @@ class TestSaleChannel(BaseTestCase):
 
             self.assertFalse(sale.has_channel_exception)
 
+            # Moving the exception to another origin moves the flag
+            sale2 = self.create_sale(1, self.channel1)
+            ChannelException.write([channel_exception], {
+                'origin': ('sale.sale', sale2.id),
+                'is_resolved': False,
+            })
+            self.assertEqual(channel_exception.origin_id, sale2.id)
+            self.assertFalse(sale.has_channel_exception)
+            self.assertTrue(sale2.has_channel_exception)
+            self.assertEqual(
+                sale2.get_channel_exceptions(), [channel_exception.id]
+            )
+
     def test_0095_check_channel_exception_searcher(self):
         """
         Check searcher for channel exception
@@ -616,10 +717,34 @@ class TestSaleChannel(BaseTestCase):
                 [sale3, sale2]
             )
 
+            ChannelException.create([{
+                'origin': '%s,%s' % (sale2.__name__, sale2.id),
+                'log': 'Sale has another exception',
+                'channel': sale2.channel.id,
+                'is_resolved': False,
+            }])
+
+            # Sale2 has a resolved and an unresolved exception
+            self.assertEqual(
+                self.Sale.search([('has_channel_exception', '=', True)]),
+                [sale2, sale1]
+            )
+            self.assertEqual(
+                self.Sale.search([('has_channel_exception', '=', False)]),
+                [sale3]
+            )
+            self.assertEqual(
+                [s.has_channel_exception for s in self.Sale.browse(
+                    [sale1.id, sale2.id, sale3.id]
+                )], [True, True, False]
+            )
+
     def test_0100_orders_import_wizard(self):
         """
         Check orders import wizard
         """
+        Job = POOL.get('sale.channel.job')
+
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
             with Transaction().set_context(
@@ -658,10 +783,160 @@ class TestSaleChannel(BaseTestCase):
                 # again
                 self.assertEqual(import_data.transition_next(), 'import_')
 
+                # Import is queued as jobs
+                self.assertEqual(import_data.transition_import_(), 'success')
+                job, = Job.search([('channel', '=', self.channel1.id)])
+                self.assertEqual(job.operation, 'import_orders')
+                self.assertEqual(job.state, 'queued')
+                self.assertTrue(
+                    ('Job #%d' % job.id) in import_data.success.message
+                )
+
                 with self.assertRaises(NotImplementedError):
                     # NotImplementedError is thrown in this case.
                     # Importing orders feature is not available in this module
-                    import_data.transition_import_()
+                    job.run()
+
+    def test_0105_job_failure(self):
+        """
+        Check failed jobs are retried with a backoff
+        """
+        Job = POOL.get('sale.channel.job')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            job = Job.enqueue(self.channel1, 'import_orders')
+            self.assertEqual(job.state, 'queued')
+            self.assertEqual(job.attempts, 0)
+
+            # Jobs which are not implemented are not retried
+            job.attempts = 1
+            job.handle_failure(NotImplementedError('Not implemented'))
+            self.assertEqual(job.state, 'failed')
+            self.assertEqual(job.message, 'Not implemented')
+
+            Job.retry([job])
+            self.assertEqual(job.state, 'queued')
+            self.assertEqual(job.attempts, 0)
+
+            job.attempts = 1
+            job.handle_failure(Exception('Timeout'))
+            self.assertEqual(job.state, 'queued')
+            first_delay = job.next_attempt - job.finished_at
+
+            job.attempts = 2
+            job.handle_failure(Exception('Timeout'))
+            self.assertEqual(job.state, 'queued')
+            self.assertEqual(
+                job.next_attempt - job.finished_at, first_delay * 2
+            )
+
+            job.attempts = 3
+            job.handle_failure(Exception('Timeout'))
+            self.assertEqual(job.state, 'failed')
+
+            job.handle_success(['sale'])
+            self.assertEqual(job.state, 'done')
+            self.assertEqual(job.processed, 1)
+
+    def test_0106_job_queue(self):
+        """
+        Check jobs are claimed, run and their outcome recorded
+        """
+        Job = POOL.get('sale.channel.job')
+        SyncLog = POOL.get('sale.channel.sync_log')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            progress = []
+
+            def export_product_prices(channel):
+                Job.report_progress(1, 2)
+                job = Job(Transaction().context['channel_job'])
+                progress.append((job.processed, job.total))
+                return [channel]
+
+            job1 = Job.enqueue(self.channel1, 'export_product_prices')
+            job2 = Job.enqueue(self.channel2, 'import_orders')
+            with nested(
+                inline_transactions(),
+                patch(
+                    self.SaleChannel, 'export_product_prices',
+                    export_product_prices
+                ),
+            ):
+                Job.process_queue()
+
+            job1, job2 = Job.browse([job1, job2])
+            self.assertEqual(progress, [(1, 2)])
+            self.assertEqual(job1.state, 'done')
+            self.assertEqual(job1.attempts, 1)
+            self.assertEqual(job1.processed, 1)
+            self.assertEqual(job1.total, 2)
+            self.assertEqual(job2.state, 'failed')
+            self.assertEqual(job2.attempts, 1)
+            log, = SyncLog.search([('channel', '=', self.channel1.id)])
+            self.assertEqual(log.operation, 'export_product_prices')
+            self.assertEqual(log.records, 1)
+            # Jobs of operations the channel does not implement failed
+            log, = SyncLog.search([('channel', '=', self.channel2.id)])
+            self.assertEqual(log.operation, 'import_orders')
+            self.assertEqual(log.state, 'failed')
+
+            # Running jobs which timed out are claimed again until they
+            # reach their maximum number of attempts
+            started_at = datetime.utcnow() - timedelta(days=1)
+            job3, job4 = Job.create([{
+                'channel': self.channel1.id,
+                'operation': 'import_orders',
+                'state': 'running',
+                'started_at': started_at,
+                'attempts': attempts,
+            } for attempts in (1, 3)])
+            with inline_transactions():
+                self.assertEqual(Job.claim_jobs(), [job3.id])
+                self.assertEqual(Job.claim_jobs(), [])
+
+            job3, job4 = Job.browse([job3, job4])
+            self.assertEqual(job3.state, 'running')
+            self.assertEqual(job3.attempts, 2)
+            self.assertEqual(job4.state, 'failed')
+            self.assertEqual(job4.attempts, 3)
+            self.assertTrue(job4.message.startswith('Timed out'))
+
+            # Failed jobs are queued again
+            def import_orders(channel):
+                raise Exception('Timeout')
+
+            with nested(
+                inline_transactions(),
+                patch(self.SaleChannel, 'import_orders', import_orders),
+            ):
+                Job.process_job(job3.id)
+            job3 = Job(job3.id)
+            self.assertEqual(job3.state, 'queued')
+            self.assertEqual(job3.message, 'Timeout')
+
+            # A run of the cron claims a bounded number of jobs
+            job5, job6 = [
+                Job.enqueue(self.channel1, 'export_product_prices')
+                for _ in xrange(2)
+            ]
+            with nested(
+                inline_transactions(),
+                sale_channel_config(job_claim_limit=1),
+                patch(
+                    self.SaleChannel, 'export_product_prices',
+                    export_product_prices
+                ),
+            ):
+                Job.process_queue()
+            self.assertEqual(
+                [job.state for job in Job.browse([job5, job6])],
+                ['done', 'queued']
+            )
 
     def test_0200_channel_availability(self):
         StockMove = POOL.get('stock.move')
@@ -700,6 +975,1186 @@ class TestSaleChannel(BaseTestCase):
                 {'type': 'bucket', 'value': 'out_of_stock'}
             )
 
+    def test_0205_listing_availability(self):
+        """
+        Check availability of listings is computed in bulk unless the per
+        listing hook is overridden
+        """
+        StockMove = POOL.get('stock.move')
+        Location = POOL.get('stock.location')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.set_channel_source(self.channel1, 'dummy')
+
+            listing1, listing2 = Listing.create([{
+                'channel': self.channel1.id,
+                'product': self.product1.id,
+                'product_identifier': 'product-1',
+            }, {
+                'channel': self.channel1.id,
+                'product': self.product2.id,
+                'product_identifier': 'product-2',
+            }])
+
+            lost_and_found, = Location.search([
+                ('type', '=', 'lost_found')
+            ])
+            with Transaction().set_context(company=self.company.id):
+                StockMove.create([{
+                    'from_location': lost_and_found,
+                    'to_location': self.channel1.warehouse.storage_location,
+                    'quantity': 10,
+                    'product': self.product1,
+                    'uom': self.product1.default_uom,
+                }])
+
+            self.assertEqual(
+                Listing.get_availabilities([listing1, listing2]), {
+                    listing1.id: {
+                        'type': 'bucket', 'value': 'in_stock', 'quantity': 10,
+                    },
+                    listing2.id: {
+                        'type': 'bucket', 'value': 'out_of_stock',
+                        'quantity': 0,
+                    },
+                }
+            )
+
+            listing1, listing2 = Listing.browse([listing1, listing2])
+            self.assertEqual(listing1.quantity, 10)
+            self.assertEqual(listing1.availability_used, 'in_stock')
+            self.assertEqual(listing2.quantity, 0)
+            self.assertEqual(listing2.availability_used, 'out_of_stock')
+
+            # Listings override the channel defaults
+            self.assertEqual(
+                self.channel1.get_availability(self.product1),
+                {'type': 'bucket', 'value': 'in_stock', 'quantity': 10}
+            )
+            self.assertEqual(
+                self.channel2.get_availabilities([
+                    self.product1, self.product2
+                ]), {
+                    self.product1.id: {'type': 'bucket', 'value': 'in_stock'},
+                    self.product2.id: {
+                        'type': 'bucket', 'value': 'out_of_stock'
+                    },
+                }
+            )
+
+            # Downstream overrides of the per listing and per product hooks
+            # are called for each listing and product
+            def get_listing_availability(listing):
+                return {'type': 'finite', 'value': 'limited', 'quantity': 1}
+
+            def get_product_availability(channel, product):
+                return {'type': 'infinite', 'value': 'in_stock'}
+
+            with nested(
+                patch(Listing, 'get_availability', get_listing_availability),
+                patch(
+                    self.SaleChannel, 'get_availability',
+                    get_product_availability
+                ),
+            ):
+                self.assertEqual(
+                    Listing.get_availability_fields(
+                        [listing1], ['availability_used']
+                    )['availability_used'], {listing1.id: 'limited'}
+                )
+                self.assertEqual(
+                    self.channel2.get_availabilities([self.product1]),
+                    {self.product1.id: {
+                        'type': 'infinite', 'value': 'in_stock'
+                    }}
+                )
+
+            # Listings are exported in chunks with their availabilities
+            chunks = list(Listing.iter_export_chunks(
+                [listing1.id, listing2.id], chunk_size=1
+            ))
+            self.assertEqual([c for c, _ in chunks], [[listing1], [listing2]])
+            self.assertEqual(
+                chunks[1][1],
+                {listing2.id: {
+                    'type': 'bucket', 'value': 'out_of_stock', 'quantity': 0,
+                }}
+            )
+            with self.assertRaises(NotImplementedError):
+                Listing.export_bulk_inventory([listing1, listing2])
+
+            # Listings whose availability was already exported are skipped
+            InventoryChange = POOL.get('sale.channel.inventory_change')
+            changes = InventoryChange.get_changes(self.channel1)
+            Listing.save_exported_availabilities(
+                [listing1, listing2],
+                Listing.get_availabilities([listing1, listing2])
+            )
+            self.assertEqual(
+                InventoryChange.get_changes(self.channel1), changes
+            )
+            listing1, listing2 = Listing.browse([listing1, listing2])
+            self.assertEqual(listing1.last_exported_availability, 'in_stock')
+            self.assertEqual(listing1.last_exported_quantity, 10)
+            Listing.export_bulk_inventory([listing1, listing2])
+            with self.assertRaises(NotImplementedError):
+                Listing.export_inventory_button([listing2])
+
+            with Transaction().set_context(company=self.company.id):
+                StockMove.create([{
+                    'from_location': lost_and_found,
+                    'to_location': self.channel1.warehouse.storage_location,
+                    'quantity': 1,
+                    'product': self.product2,
+                    'uom': self.product2.default_uom,
+                }])
+            self.assertEqual(
+                Listing.filter_changed_availabilities(
+                    [listing1, listing2],
+                    Listing.get_availabilities([listing1, listing2])
+                ), [listing2]
+            )
+
+    def test_0210_inventory_change_log(self):
+        """
+        Check listings to export inventory are picked from the change log
+        """
+        StockMove = POOL.get('stock.move')
+        Location = POOL.get('stock.location')
+        Listing = POOL.get('product.product.channel_listing')
+        InventoryChange = POOL.get('sale.channel.inventory_change')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            self.set_channel_source(self.channel1, 'dummy')
+
+            listing1, listing2 = Listing.create([{
+                'channel': self.channel1.id,
+                'product': self.product1.id,
+                'product_identifier': 'product-1',
+            }, {
+                'channel': self.channel1.id,
+                'product': self.product2.id,
+                'product_identifier': 'product-2',
+            }])
+
+            # Without any export all active listings are exported
+            self.assertEqual(
+                set(self.channel1.get_listings_to_export_inventory()),
+                set([listing1, listing2])
+            )
+
+            export_time = datetime.utcnow() - timedelta(minutes=1)
+            self.SaleChannel.write([self.channel1], {
+                'last_inventory_export_time': export_time,
+            })
+
+            # New listings are logged as changed
+            self.assertEqual(
+                set(self.channel1.get_listings_to_export_inventory()),
+                set([listing1, listing2])
+            )
+
+            InventoryChange.delete_changes(
+                sum(InventoryChange.get_changes(self.channel1).values(), [])
+            )
+            self.assertEqual(
+                self.channel1.get_listings_to_export_inventory(), []
+            )
+
+            lost_and_found, = Location.search([
+                ('type', '=', 'lost_found')
+            ])
+            with Transaction().set_context(company=self.company.id):
+                StockMove.create([{
+                    'from_location': lost_and_found,
+                    'to_location': self.channel1.warehouse.storage_location,
+                    'quantity': 10,
+                    'product': self.product1,
+                    'uom': self.product1.default_uom,
+                }])
+            self.assertEqual(
+                self.channel1.get_listings_to_export_inventory(), [listing1]
+            )
+
+            # Changes logged after the last change are left alone
+            last_change = InventoryChange.get_last_change(self.channel1)
+            Listing.write([listing2], {'product_identifier': 'product-2a'})
+            with Transaction().set_context(last_inventory_change=last_change):
+                self.assertEqual(
+                    self.channel1.get_listings_to_export_inventory(),
+                    [listing1]
+                )
+            changes = InventoryChange.get_changes(self.channel1, last_change)
+            self.assertEqual(changes.keys(), [listing1.id])
+            self.assertEqual(
+                InventoryChange.get_changes(self.channel1).keys(),
+                [listing1.id, listing2.id]
+            )
+            InventoryChange.delete_changes(changes[listing1.id])
+            self.assertEqual(
+                self.channel1.get_listings_to_export_inventory(), [listing2]
+            )
+
+            # Compacting keeps only the last change of each listing
+            Listing.write([listing2], {'product_identifier': 'product-2b'})
+            with Transaction().set_context(company=self.company.id):
+                StockMove.create([{
+                    'from_location': lost_and_found,
+                    'to_location': self.channel1.warehouse.storage_location,
+                    'quantity': 1,
+                    'product': self.product1,
+                    'uom': self.product1.default_uom,
+                }])
+            changes = InventoryChange.get_changes(self.channel1)
+            self.assertEqual(len(changes[listing2.id]), 2)
+            InventoryChange.compact_changes()
+            self.assertEqual(InventoryChange.get_changes(self.channel1), {
+                listing1.id: [max(changes[listing1.id])],
+                listing2.id: [max(changes[listing2.id])],
+            })
+            self.assertEqual(
+                self.channel1.get_listings_to_export_inventory(),
+                [listing1, listing2]
+            )
+
+            # Listings to export are read in pages
+            self.assertEqual(
+                self.channel1.get_listing_ids_to_export_inventory(limit=1),
+                [listing1.id]
+            )
+            self.assertEqual(
+                self.channel1.get_listing_ids_to_export_inventory(
+                    after=listing1.id, limit=1
+                ), [listing2.id]
+            )
+            with sale_channel_config(inventory_export_chunk_size=1):
+                self.assertEqual(
+                    list(self.channel1.iter_listing_ids_to_export_inventory()),
+                    [[listing1.id], [listing2.id]]
+                )
+
+                def get_listings_to_export_inventory(channel):
+                    return [listing2, listing1]
+
+                with patch(
+                    self.SaleChannel, 'get_listings_to_export_inventory',
+                    get_listings_to_export_inventory
+                ):
+                    self.assertEqual(
+                        list(self.channel1.iter_listing_ids_to_export_inventory(
+                            after=listing1.id
+                        )), [[listing2.id]]
+                    )
+            InventoryChange.delete_changes([max(changes[listing1.id])])
+
+            # Disabled listings are not exported
+            Listing.write([listing2], {'state': 'disabled'})
+            self.assertEqual(
+                self.channel1.get_listings_to_export_inventory(), []
+            )
+
+            with Transaction().set_context(inventory_delta_fallback=True):
+                self.assertEqual(
+                    self.channel1.get_listings_to_export_inventory(),
+                    [listing1]
+                )
+
+    def test_0220_run_for_channel(self):
+        """
+        Check the result reported when running a method for a channel
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            self.assertEqual(
+                self.SaleChannel.run_for_channel(
+                    self.channel1.id, 'update_order_status'
+                ), ('done', '')
+            )
+            self.assertEqual(
+                self.SaleChannel.run_for_channel(
+                    self.channel1.id, 'import_orders'
+                ), ('not_implemented', '')
+            )
+
+            status, message = self.SaleChannel.run_for_channel(
+                self.channel1.id, 'get_order_states_to_import'
+            )
+            self.assertEqual(status, 'failed')
+            self.assertTrue(message)
+
+            # Channels are run one after the other on SQLite
+            SyncLog = POOL.get('sale.channel.sync_log')
+            with inline_transactions():
+                results = self.SaleChannel.run_for_channels(
+                    'update_order_status', [self.channel1, self.channel2]
+                )
+            self.assertEqual(results, {
+                self.channel1.id: ('done', ''),
+                self.channel2.id: ('done', ''),
+            })
+            self.assertEqual(len(SyncLog.search([
+                ('operation', '=', 'update_order_status'),
+                ('state', '=', 'done'),
+            ])), 2)
+
+            # Runs of methods the channels do not implement are not logged
+            with inline_transactions():
+                results = self.SaleChannel.run_for_channels(
+                    'import_orders', [self.channel1]
+                )
+            self.assertEqual(
+                results, {self.channel1.id: ('not_implemented', '')}
+            )
+            self.assertEqual(
+                SyncLog.search([('operation', '=', 'import_orders')]), []
+            )
+
+    def test_0225_channel_worker_pool(self):
+        """
+        Check the worker pool runs calls on a fixed number of threads
+        """
+        from trytond.modules.sale_channel.channel import ChannelWorkerPool
+
+        running = []
+        concurrency = []
+        lock = threading.Lock()
+        release = threading.Event()
+
+        def call(key):
+            with lock:
+                running.append(key)
+                concurrency.append(len(running))
+            try:
+                if key == 'stuck':
+                    release.wait(5)
+                elif key == 'failing':
+                    raise ValueError('Failed')
+                else:
+                    time.sleep(0.05)
+            finally:
+                with lock:
+                    running.remove(key)
+            return ('done', '')
+
+        pool = ChannelWorkerPool(2)
+        keys = range(6) + ['failing']
+        self.assertEqual(pool.map(call, keys), dict(
+            [(key, ('done', '')) for key in range(6)] +
+            [('failing', ('failed', 'Failed'))]
+        ))
+        self.assertEqual(max(concurrency), 2)
+
+        # Timed out calls keep their worker until they finish, the calls
+        # which can not start are reported as timed out too
+        pool = ChannelWorkerPool(1, timeout=0.2)
+        results = pool.map(call, ['stuck', 1])
+        self.assertEqual(results['stuck'][0], 'timeout')
+        self.assertEqual(results[1][0], 'timeout')
+        self.assertEqual(pool.started.keys(), ['stuck'])
+        release.set()
+
+    def test_0230_import_orders_bulk(self):
+        """
+        Check that orders are imported in bulk only once
+        """
+        SaleChannel = POOL.get('sale.channel')
+
+        def get_sale_values(channel, order_info):
+            return {
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'currency': channel.currency.id,
+                'payment_term': channel.payment_term.id,
+                'sale_date': POOL.get('ir.date').today(),
+                'lines': [('create', [{
+                    'type': 'comment',
+                    'description': 'Line of %s' % order_info['id'],
+                    'channel_identifier': '%s-1' % order_info['id'],
+                }])],
+            }
+
+        hooks = {
+            'get_order_identifier': lambda channel, info: info['id'],
+            'get_sale_values': get_sale_values,
+            'get_order_state': lambda channel, info: info['state'],
+        }
+        originals = dict(
+            (name, getattr(SaleChannel, name)) for name in hooks
+        )
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.channel1.create_order_state('shipped', 'Shipped')
+            self.channel1.create_order_state('pending', 'Pending')
+            self.channel1.order_states[0].action = 'import_as_past'
+            self.channel1.order_states[0].save()
+
+            with self.assertRaises(NotImplementedError):
+                self.channel1.import_orders_bulk([{'id': 'O1'}])
+
+            for name, method in hooks.items():
+                setattr(SaleChannel, name, method)
+            try:
+                with nested(
+                    Transaction().set_context(company=self.company.id),
+                    inline_transactions(),
+                ):
+                    sales = self.channel1.import_orders_bulk([
+                        {'id': 'O1', 'state': 'shipped'},
+                        {'id': 'O2', 'state': 'pending'},
+                        {'id': 'O1', 'state': 'shipped'},
+                    ])
+                    self.assertEqual(len(set(sales)), 2)
+                    self.assertEqual(sales[0], sales[2])
+                    self.assertEqual(sales[0].state, 'done')
+                    self.assertEqual(sales[1].state, 'draft')
+                    self.assertEqual(len(sales[1].lines), 1)
+
+                    # Orders already imported are not created again
+                    sales2 = self.channel1.import_orders_bulk([
+                        {'id': 'O2', 'state': 'pending'},
+                        {'id': 'O3', 'state': 'pending'},
+                    ])
+                    self.assertEqual(sales2[0], sales[1])
+                    self.assertEqual(
+                        self.Sale.search([
+                            ('channel', '=', self.channel1.id),
+                        ], count=True), 3
+                    )
+                    self.assertEqual(sales2[1].channel_identifier, 'O3')
+
+                    # Channel identifiers are unique across channels
+                    self.channel2.create_order_state('pending', 'Pending')
+                    sales3 = self.channel2.import_orders_bulk([
+                        {'id': 'O3', 'state': 'pending'},
+                    ])
+                    self.assertEqual(sales3, [sales2[1]])
+                    self.assertEqual(
+                        self.Sale.search([
+                            ('channel', '=', self.channel2.id),
+                        ], count=True), 0
+                    )
+            finally:
+                for name, method in originals.items():
+                    setattr(SaleChannel, name, method)
+
+    def test_0240_sale_defaults(self):
+        """
+        Check that sale defaults follow the changes of the channel
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            defaults = self.SaleChannel.get_sale_defaults(self.channel1.id)
+            self.assertEqual(defaults['invoice_method'], 'manual')
+            self.assertEqual(defaults['company'], self.company.id)
+
+            with Transaction().set_context(current_channel=self.channel1.id):
+                self.assertEqual(self.Sale.default_invoice_method(), 'manual')
+
+                self.SaleChannel.write([self.channel1], {
+                    'invoice_method': 'order',
+                })
+                self.assertEqual(self.Sale.default_invoice_method(), 'order')
+                self.assertEqual(
+                    self.Sale.default_payment_term(),
+                    self.channel1.payment_term.id
+                )
+
+            # Writing other fields keeps the cache
+            self.SaleChannel.write([self.channel1], {
+                'last_order_import_time': datetime.utcnow(),
+            })
+            self.assertEqual(
+                self.SaleChannel._sale_defaults_cache.get(self.channel1.id),
+                dict(defaults, invoice_method='order')
+            )
+
+    def test_0250_order_state_map(self):
+        """
+        Check that the order state map follows the changes of order states
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            self.assertEqual(
+                self.channel1.get_tryton_action('paid')['action'],
+                'do_not_import'
+            )
+            order_state = self.channel1.create_order_state('paid', 'Paid')
+            self.assertEqual(
+                self.channel1.create_order_state('paid', 'Paid'), order_state
+            )
+            with self.assertRaises(UserError):
+                self.channel1.get_order_states_to_import()
+
+            order_state.action = 'process_manually'
+            order_state.invoice_method = 'order'
+            order_state.save()
+            self.assertEqual(self.channel1.get_tryton_action('paid'), {
+                'action': 'process_manually',
+                'invoice_method': 'order',
+                'shipment_method': order_state.shipment_method,
+            })
+            self.assertEqual(
+                self.channel1.get_order_states_to_import(), [order_state]
+            )
+
+            POOL.get('sale.channel.order_state').delete([order_state])
+            self.assertEqual(
+                self.channel1.get_tryton_action('paid')['action'],
+                'do_not_import'
+            )
+
+    def test_0260_shipping_carriers(self):
+        """
+        Check the lookup of shipping carriers by code
+        """
+        SaleChannelCarrier = POOL.get('sale.channel.carrier')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            SaleChannelCarrier.create([{
+                'name': 'Ground',
+                'code': 'ground',
+                'channel': self.channel1.id,
+            }, {
+                'name': 'Air',
+                'code': 'air',
+                'channel': self.channel2.id,
+            }])
+
+            self.assertIsNone(self.channel1.get_shipping_carrier('ground'))
+            with self.assertRaises(UserError) as cm:
+                self.channel1.get_shipping_carriers(['ground', 'air', 'sea'])
+            self.assertIn('air, sea', cm.exception.args[1][0])
+            self.assertEqual(
+                self.channel1.get_shipping_carriers(
+                    ['ground', 'air'], silent=True
+                ), [None, None]
+            )
+
+            SaleChannelCarrier.create([{
+                'name': 'Air',
+                'code': 'air',
+                'channel': self.channel1.id,
+            }])
+            self.assertEqual(
+                self.channel1.get_shipping_carriers(['ground', 'air']),
+                [None, None]
+            )
+
+    def test_0270_allowed_channels_cache(self):
+        """
+        Check that allowed channels follow the changes of channel users
+        """
+        User = POOL.get('res.user')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            #      USER       Channel1    Channel2    Channel3  Channel4
+            #    sale_user       -           R           RW       RW
+            with Transaction().set_user(self.sales_user_id):
+                sale_user = User(self.sales_user_id)
+                self.assertEqual(
+                    set(map(int, sale_user.allowed_create_channels)),
+                    set([self.channel3.id, self.channel4.id])
+                )
+
+            User.write([User(self.sales_user_id)], {
+                'create_channels': [('add', [self.channel1.id])],
+                'read_channels': [('remove', [self.channel2.id])],
+            })
+
+            with Transaction().set_user(self.sales_user_id):
+                sale_user = User(self.sales_user_id)
+                self.assertEqual(
+                    set(map(int, sale_user.allowed_create_channels)),
+                    set([self.channel1.id, self.channel3.id, self.channel4.id])
+                )
+                self.assertEqual(
+                    set(map(int, sale_user.allowed_read_channels)),
+                    set([self.channel1.id, self.channel3.id, self.channel4.id])
+                )
+
+            # Writing the time of the last import keeps the cache, archiving
+            # a channel clears it
+            key = (self.sales_user_id, self.sales_user_id)
+            self.SaleChannel.write([self.channel1], {
+                'last_order_import_time': datetime.utcnow(),
+            })
+            self.assertTrue(User._allowed_channels_cache.get(key))
+            self.SaleChannel.write([self.channel4], {'active': False})
+            self.assertIsNone(User._allowed_channels_cache.get(key))
+
+    def test_0280_archive_resolved_exceptions(self):
+        """
+        Check that old resolved exceptions are archived
+        """
+        ChannelException = POOL.get('channel.exception')
+        Archive = POOL.get('channel.exception.archive')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self.create_sale(1, self.channel1)
+            exceptions = ChannelException.create([{
+                'origin': '%s,%s' % (sale.__name__, sale.id),
+                'log': 'Exception %d' % i,
+                'channel': sale.channel.id,
+            } for i in range(3)])
+
+            ChannelException.resolve_exception_button(exceptions[:2])
+            self.assertEqual(
+                [e.is_resolved for e in exceptions], [True, True, False]
+            )
+            self.assertTrue(all(e.resolved_at for e in exceptions[:2]))
+
+            # Nothing is old enough to be archived
+            self.assertEqual(ChannelException.archive_resolved(days=1), 0)
+
+            ChannelException.write([exceptions[0]], {
+                'resolved_at': datetime.utcnow() - timedelta(days=2),
+            })
+            self.assertEqual(ChannelException.archive_resolved(days=1), 1)
+
+            self.assertEqual(
+                ChannelException.search([], count=True), 2
+            )
+            archive, = Archive.search([])
+            self.assertEqual(archive.log, 'Exception 0')
+            self.assertEqual(archive.channel, self.channel1)
+            self.assertEqual(archive.origin, 'sale.sale,%d' % sale.id)
+
+    def test_0290_checkpoint(self):
+        """
+        Check that an interrupted export resumes after its checkpoint
+        """
+        Checkpoint = POOL.get('sale.channel.checkpoint')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            self.assertIsNone(
+                Checkpoint.get_checkpoint(self.channel1, 'inventory')
+            )
+            self.assertEqual(
+                Checkpoint.get_remaining_ids([3, 1, 2], None), [1, 2, 3]
+            )
+
+            started_at = datetime.utcnow().replace(microsecond=0)
+            Checkpoint.create([{
+                'channel': self.channel1.id,
+                'stream': 'inventory',
+                'started_at': started_at,
+                'watermark': 10,
+                'position': 2,
+            }])
+            checkpoint = Checkpoint.get_checkpoint(self.channel1, 'inventory')
+            self.assertEqual(checkpoint['started_at'], started_at)
+            self.assertEqual(checkpoint['watermark'], 10)
+            self.assertIsNone(
+                Checkpoint.get_checkpoint(self.channel2, 'inventory')
+            )
+            self.assertEqual(
+                Checkpoint.get_remaining_ids([4, 1, 3, 2], checkpoint), [3, 4]
+            )
+
+            Checkpoint.save_position(checkpoint['id'], 3)
+            checkpoint = Checkpoint.get_checkpoint(self.channel1, 'inventory')
+            self.assertEqual(
+                Checkpoint.get_remaining_ids([4, 1, 3, 2], checkpoint), [4]
+            )
+
+    def test_0295_resume_inventory_export(self):
+        """
+        Check that an inventory export failing after a chunk resumes after
+        it on the next run
+        """
+        Listing = POOL.get('product.product.channel_listing')
+        InventoryChange = POOL.get('sale.channel.inventory_change')
+        Checkpoint = POOL.get('sale.channel.checkpoint')
+
+        exported = []
+        failures = [Exception('Connection reset')]
+
+        def export_inventory_chunk(cls, listings, availabilities):
+            # The second chunk fails once
+            if exported and failures:
+                raise failures.pop()
+            exported.extend(listings)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.set_channel_source(self.channel1, 'dummy')
+
+            export_time = datetime.utcnow().replace(microsecond=0) - \
+                timedelta(days=1)
+            self.SaleChannel.write([self.channel1], {
+                'last_inventory_export_time': export_time,
+            })
+            listings = Listing.create([{
+                'channel': self.channel1.id,
+                'product': product.id,
+                'product_identifier': identifier,
+            } for product, identifier in [
+                (self.product1, 'product-1'),
+                (self.product2, 'product-2'),
+                (self.product1, 'product-1b'),
+            ]])
+            listing1, listing2, listing3 = sorted(listings, key=int)
+            # Changes of listings disabled since are deleted too
+            disabled, = Listing.create([{
+                'channel': self.channel1.id,
+                'product': self.product2.id,
+                'product_identifier': 'product-2b',
+            }])
+            Listing.write([disabled], {'state': 'disabled'})
+
+            with nested(
+                inline_transactions(),
+                sale_channel_config(inventory_export_chunk_size=1),
+                patch(
+                    Listing, 'export_inventory_chunk',
+                    classmethod(export_inventory_chunk)
+                ),
+            ):
+                with self.assertRaises(Exception):
+                    self.channel1.export_inventory()
+
+                # The first chunk is exported, its changes deleted and the
+                # availabilities exported saved
+                self.assertEqual(exported, [listing1])
+                self.assertEqual([
+                    listing.last_exported_availability
+                    for listing in Listing.browse([listing1, listing2])
+                ], ['out_of_stock', None])
+                checkpoint = Checkpoint.get_checkpoint(
+                    self.channel1, 'inventory'
+                )
+                self.assertEqual(checkpoint['position'], listing1.id)
+                self.assertEqual(
+                    sorted(InventoryChange.get_changes(self.channel1)),
+                    sorted([listing2.id, listing3.id, disabled.id])
+                )
+                self.assertEqual(
+                    self.SaleChannel(self.channel1.id)
+                    .last_inventory_export_time, export_time
+                )
+
+                # The next run resumes after the first chunk
+                self.channel1.export_inventory()
+
+            self.assertEqual(exported, [listing1, listing2, listing3])
+            self.assertEqual(InventoryChange.get_changes(self.channel1), {})
+            self.assertIsNone(
+                Checkpoint.get_checkpoint(self.channel1, 'inventory')
+            )
+            self.assertEqual(
+                self.SaleChannel(self.channel1.id).last_inventory_export_time,
+                checkpoint['started_at']
+            )
+
+    def test_0296_export_bulk_inventory_override(self):
+        """
+        Check that the chunks of changed listings are exported through an
+        override of export_bulk_inventory
+        """
+        Listing = POOL.get('product.product.channel_listing')
+
+        exported = []
+
+        def export_bulk_inventory(cls, listings):
+            exported.append(list(listings))
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.set_channel_source(self.channel1, 'dummy')
+
+            self.SaleChannel.write([self.channel1], {
+                'last_inventory_export_time': datetime.utcnow(),
+            })
+            listing1, listing2, listing3 = sorted(Listing.create([{
+                'channel': self.channel1.id,
+                'product': product.id,
+                'product_identifier': identifier,
+            } for product, identifier in [
+                (self.product1, 'product-1'),
+                (self.product2, 'product-2'),
+                (self.product1, 'product-1b'),
+            ]]), key=int)
+
+            with nested(
+                inline_transactions(),
+                sale_channel_config(inventory_export_chunk_size=2),
+                patch(
+                    Listing, 'export_bulk_inventory',
+                    classmethod(export_bulk_inventory)
+                ),
+            ):
+                self.channel1.export_inventory()
+
+            self.assertEqual(exported, [[listing1, listing2], [listing3]])
+            self.assertEqual(
+                Listing(listing3.id).last_exported_availability,
+                'out_of_stock'
+            )
+
+    def test_0300_rate_limit(self):
+        """
+        Check the token bucket and the leases of the channel rate limit
+        """
+        RateLimit = POOL.get('sale.channel.rate_limit')
+        Lease = POOL.get('sale.channel.rate_limit.lease')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            # Channels without rate limit do not wait
+            self.assertIsNone(self.channel1.rate_limit)
+            self.assertEqual(self.channel1.rate_limit_burst, 1)
+            with self.channel1.rate_limited():
+                pass
+
+            state = {'tokens': 2, 'updated': 100}
+
+            # Burst of 2 calls at 2 calls per second
+            state, wait = RateLimit.take(state, 100, 2, 2)
+            self.assertEqual(wait, 0)
+            state, wait = RateLimit.take(state, 100, 2, 2)
+            self.assertEqual(wait, 0)
+            self.assertEqual(state['tokens'], 0)
+            state, wait = RateLimit.take(state, 100.25, 2, 2)
+            self.assertEqual(wait, 0.25)
+            self.assertEqual(state['tokens'], 0.5)
+            state, wait = RateLimit.take(state, 100.5, 2, 2)
+            self.assertEqual(wait, 0)
+
+            # Tokens never exceed the burst
+            state, wait = RateLimit.take(state, 200, 2, 2)
+            self.assertEqual(state['tokens'], 1)
+
+            # Without rate, tokens are not counted
+            self.assertEqual(RateLimit.take(state, 200, None, 2), (state, 0))
+
+            # The concurrency is limited without rate
+            self.SaleChannel.write([self.channel1], {
+                'rate_limit_concurrency': 1,
+            })
+            channel = self.SaleChannel(self.channel1.id)
+            with inline_transactions():
+                with channel.rate_limited():
+                    lease, = Lease.search([])
+                    wait, lease_id = RateLimit._take(channel)
+                    self.assertTrue(wait > 0)
+                    self.assertIsNone(lease_id)
+                self.assertEqual(Lease.search([]), [])
+
+                # Calls refused do not extend the leases and lost leases
+                # expire
+                lease_id = RateLimit.acquire(channel)
+                self.assertEqual(RateLimit._take(channel), (0.1, None))
+                Lease.write([Lease(lease_id)], {'expires': time.time() - 1})
+                wait, other_lease_id = RateLimit._take(channel)
+                self.assertEqual(wait, 0)
+                self.assertEqual(
+                    map(int, Lease.search([])), [other_lease_id]
+                )
+                RateLimit.release(other_lease_id)
+
+            # Calls are rate limited without concurrency limit
+            self.SaleChannel.write([channel], {
+                'rate_limit': 1,
+                'rate_limit_concurrency': None,
+            })
+            channel = self.SaleChannel(self.channel1.id)
+            with inline_transactions():
+                self.assertIsNone(RateLimit.acquire(channel))
+                wait, lease_id = RateLimit._take(channel)
+                self.assertTrue(0 < wait <= 1)
+                self.assertIsNone(lease_id)
+            rate_limit, = RateLimit.search([])
+            self.assertTrue(rate_limit.tokens < 1)
+
+    def test_0310_sync_log_statistics(self):
+        """
+        Check the statistics measured for the sync logs of channel runs
+        """
+        SyncLog = POOL.get('sale.channel.sync_log')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with SyncLog.measure() as stats:
+                self.SaleChannel.search([])
+                with SyncLog.measure() as inner_stats:
+                    self.Sale.search([])
+                self.SaleChannel.search([])
+            self.assertTrue(inner_stats['queries'] > 0)
+            self.assertTrue(stats['queries'] >= inner_stats['queries'] + 2)
+            self.assertTrue(stats['duration'] >= inner_stats['duration'])
+
+            # The cursor is restored
+            with SyncLog.measure() as stats:
+                pass
+            self.assertEqual(stats['queries'], 0)
+            self.assertFalse('execute' in vars(Transaction().cursor))
+
+            self.assertEqual(SyncLog.count_records([1, 2]), 2)
+            self.assertIsNone(SyncLog.count_records(None))
+
+            stats = {}
+            self.assertEqual(
+                self.SaleChannel.run_for_channel(
+                    self.channel1.id, 'get_order_states_to_import', stats
+                )[0], 'failed'
+            )
+            self.assertTrue(stats['queries'] > 0)
+            self.assertFalse('records' in stats)
+
+    def test_0320_process_to_channel_states(self):
+        """
+        Check that imported sales are processed in batches per action
+        """
+        StockMove = POOL.get('stock.move')
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            for code, action in [
+                    ('paid', 'process_automatically'),
+                    ('pending', 'process_manually'),
+                    ('shipped', 'import_as_past')]:
+                order_state = self.channel1.create_order_state(code, code)
+                order_state.action = action
+                order_state.invoice_method = 'manual'
+                order_state.shipment_method = 'order'
+                order_state.save()
+
+            lost_and_found, = self.Location.search([
+                ('type', '=', 'lost_found')
+            ])
+            with Transaction().set_context(company=self.company.id):
+                StockMove.do(StockMove.create([{
+                    'from_location': lost_and_found,
+                    'to_location': self.channel1.warehouse.storage_location,
+                    'quantity': 1,
+                    'product': self.product1,
+                    'uom': self.product1.default_uom,
+                    'effective_date': Date.today(),
+                }]))
+
+                sales = self.Sale.create([{
+                    'channel': self.channel1.id,
+                    'channel_identifier': 'order-%d' % index,
+                    'party': self.sale_party.id,
+                    'invoice_address': self.sale_party.addresses[0].id,
+                    'shipment_address': self.sale_party.addresses[0].id,
+                    'payment_term': self.payment_term.id,
+                    'sale_date': Date.today(),
+                    'lines': [('create', [{
+                        'type': 'line',
+                        'product': product.id,
+                        'description': product.rec_name,
+                        'quantity': 1,
+                        'unit': product.default_uom.id,
+                        'unit_price': Decimal('10'),
+                    }])],
+                } for index, product in enumerate([
+                    self.product1, self.product2, self.product1,
+                    self.product1,
+                ])])
+
+                self.Sale.process_to_channel_states(zip(sales, [
+                    'paid', 'paid', 'pending', 'shipped',
+                ]))
+
+            sales = self.Sale.browse(sales)
+            self.assertEqual(
+                [s.state for s in sales],
+                ['processing', 'processing', 'confirmed', 'done']
+            )
+            self.assertEqual(
+                set(s.shipment_method for s in sales), set(['order'])
+            )
+            # Only the shipment of the product in stock is assigned
+            self.assertEqual(
+                [[sh.state for sh in s.shipments] for s in sales[:2]],
+                [['assigned'], ['waiting']]
+            )
+            self.assertFalse(sales[0].shipment_assignment_pending)
+
+            # Shipments of deferring channels are assigned later
+            self.SaleChannel.write([self.channel1], {
+                'defer_shipment_assignment': True,
+            })
+            with Transaction().set_context(company=self.company.id):
+                StockMove.do(StockMove.create([{
+                    'from_location': lost_and_found,
+                    'to_location': self.channel1.warehouse.storage_location,
+                    'quantity': 1,
+                    'product': self.product1,
+                    'uom': self.product1.default_uom,
+                    'effective_date': Date.today(),
+                }]))
+                sale, = self.Sale.copy([sales[0]])
+                self.Sale.process_to_channel_states([(sale, 'paid')])
+                sale = self.Sale(sale.id)
+                self.assertTrue(sale.shipment_assignment_pending)
+                self.assertEqual(
+                    [sh.state for sh in sale.shipments], ['waiting']
+                )
+
+                # The cron user can not read the channels of the sales
+                cron_user_id = POOL.get('ir.model.data').get_id(
+                    'sale_channel', 'user_trigger_orders'
+                )
+                with Transaction().set_user(cron_user_id):
+                    assigned = self.Sale.assign_pending_shipments()
+            sale = self.Sale(sale.id)
+            self.assertEqual(assigned, list(sale.shipments))
+            self.assertEqual([sh.state for sh in sale.shipments], ['assigned'])
+            self.assertFalse(sale.shipment_assignment_pending)
+            self.assertEqual(self.Sale.assign_pending_shipments(), [])
+
+    def test_0330_order_claims(self):
+        """
+        Check the claims of orders to import
+        """
+        OrderClaim = POOL.get('sale.channel.order_claim')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self.create_sale(1, self.channel2)
+            sale.channel_identifier = 'O1'
+            sale.save()
+
+            # SQLite serializes the imports, every order not imported is
+            # claimed, whatever the channel of the sale imported
+            with inline_transactions():
+                self.assertEqual(OrderClaim.get_imported(['O1', 'O2']), {'O1'})
+                self.assertEqual(
+                    OrderClaim.claim(['O3', 'O1', 'O2', 'O3']), ['O2', 'O3']
+                )
+                self.assertEqual(OrderClaim.claim([]), [])
+
+    def test_0340_order_import_windows(self):
+        """
+        Check that orders are imported in windows and the last import time
+        only moves over windows done without gap
+        """
+        ImportWindow = POOL.get('sale.channel.import_window')
+        Job = POOL.get('sale.channel.job')
+        SaleChannel = POOL.get('sale.channel')
+
+        start = datetime(2015, 1, 1)
+        self.assertEqual(ImportWindow.split(start, start, 3600), [])
+        self.assertEqual(
+            ImportWindow.split(start, start + timedelta(minutes=150), 3600), [
+                (start, start + timedelta(hours=1)),
+                (start + timedelta(hours=1), start + timedelta(hours=2)),
+                (start + timedelta(hours=2), start + timedelta(minutes=150)),
+            ]
+        )
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            now = datetime.utcnow().replace(microsecond=0)
+            self.SaleChannel.write([self.channel1], {
+                'last_order_import_time': now - timedelta(minutes=150),
+            })
+            windows = self.channel1.plan_order_import()
+            self.assertEqual(len(windows), 3)
+            ends = [w.end for w in windows]
+            self.assertEqual(
+                [w.job.operation for w in windows],
+                ['import_order_window'] * 3
+            )
+            self.assertEqual(windows[0].job.argument, str(windows[0].id))
+
+            with self.assertRaises(NotImplementedError):
+                windows[1].job.run()
+
+            imported = []
+
+            def import_orders_between(channel, start, end):
+                imported.append((start, end))
+                return sales
+
+            # An order claimed by another transaction leaves the window
+            # pending with a new job importing it later
+            sales = [None]
+            job = windows[1].job
+            with patch(
+                SaleChannel, 'import_orders_between', import_orders_between
+            ):
+                self.assertEqual(windows[1].job.run(), [])
+                window = ImportWindow(windows[1].id)
+                self.assertEqual(window.state, 'pending')
+                self.assertNotEqual(window.job, job)
+                self.assertEqual(window.job.argument, str(window.id))
+                self.assertTrue(window.job.next_attempt > now)
+
+                sales = []
+                window.job.run()
+            self.assertEqual(imported, [(windows[1].start, windows[1].end)] * 2)
+
+            # The second window is done but not the first one
+            self.assertEqual(
+                ImportWindow.get_done_prefix(ImportWindow.browse(windows)), []
+            )
+            # New windows start after the last one planned
+            planned = self.channel1.plan_order_import()
+            self.assertEqual(
+                self.channel1.last_order_import_time,
+                now - timedelta(minutes=150)
+            )
+
+            ImportWindow.write([windows[0]], {'state': 'done'})
+            planned += self.channel1.plan_order_import()
+            channel = self.SaleChannel(self.channel1.id)
+            self.assertEqual(channel.last_order_import_time, ends[1])
+            self.assertEqual(
+                ImportWindow.search([('channel', '=', channel.id)]),
+                [windows[2]] + planned
+            )
+            self.assertEqual(
+                Job.search([('channel', '=', channel.id)], count=True),
+                4 + len(planned)
+            )
+            if planned:
+                self.assertEqual(planned[0].start, ends[2])
+
+            # A window whose job failed for good is kept but no longer holds
+            # back the last order import time
+            job = Job(windows[2].job.id)
+            job.attempts = job.max_attempts
+            job.handle_failure(Exception('Down'))
+            self.assertEqual(ImportWindow(windows[2].id).state, 'failed')
+            ImportWindow.write(planned, {'state': 'done'})
+            end = (windows + planned)[-1].end
+            for _ in xrange(2):
+                self.channel1.plan_order_import()
+                channel = self.SaleChannel(self.channel1.id)
+                self.assertEqual(channel.last_order_import_time, end)
+                self.assertEqual(
+                    ImportWindow.search([
+                        ('channel', '=', channel.id),
+                        ('state', '!=', 'pending'),
+                    ]), [windows[2]]
+                )
+
     def test_0095_check_duplicate_channel_identifier_for_sale(self):
         """
         Check if error is raised for duplicate channel identifier in sale
@@ -719,6 +2174,11 @@ class TestSaleChannel(BaseTestCase):
                 sale2.channel_identifier = 'Test Sale 1'
                 sale2.save()
 
+            # The failed save is not rolled back by the test, the instance
+            # check reports the duplicate too
+            with self.assertRaises(UserError):
+                sale1.check_channel_identifier()
+
     def test_0095_check_duplicate_channel_identifier_for_sale_line(self):
         """
         Check if error is raised for duplicate channel identifier in sale line
@@ -728,12 +2188,13 @@ class TestSaleChannel(BaseTestCase):
 
             sale = self.create_sale(1, self.channel1)
 
-            self.SaleLine.create([{
+            line, = self.SaleLine.create([{
                 'type': 'comment',
                 'channel_identifier': 'Sale Line 1',
                 'description': 'Sale Line',
                 'sale': sale.id
             }])
+            line.check_channel_identifier()
 
             # Create sale line with same channel identifer, should raise error
             with self.assertRaises(UserError):
@@ -744,6 +2205,20 @@ class TestSaleChannel(BaseTestCase):
                     'description': 'Sale Line',
                 }])
 
+            # All duplicates of a batch are reported at once
+            with self.assertRaises(UserError) as cm:
+                self.SaleLine.create([{
+                    'type': 'comment',
+                    'channel_identifier': identifier,
+                    'sale': sale,
+                    'description': 'Sale Line',
+                } for identifier in [
+                    'Sale Line 2', 'Sale Line 1', 'Sale Line 2', 'Sale Line 3'
+                ]])
+            message = cm.exception.args[1][0]
+            self.assertIn('"Sale Line 1", "Sale Line 2"', message)
+            self.assertNotIn('Sale Line 3', message)
+
     def test_0100_return_sale_with_channel_identifier(self):
         """
         Check if return sale works with channel_identifier
@@ -839,6 +2314,31 @@ class TestSaleChannel(BaseTestCase):
             self.assertEqual(
                 new_channel.get_tax('new_channel_tax', Decimal('8.00')), tax1
             )
+            self.assertEqual(new_channel.get_tax(None, 8.0), tax1)
+            self.assertEqual(
+                new_channel.get_taxes([
+                    ('new_channel_tax', Decimal('8')), (None, Decimal('8')),
+                ]), [tax1, tax1]
+            )
+
+            with self.assertRaises(UserError) as cm:
+                new_channel.get_taxes([
+                    ('new_channel_tax', Decimal('8')),
+                    ('vat', Decimal('8')),
+                    ('new_channel_tax', Decimal('5')),
+                ])
+            message = cm.exception.args[1][0]
+            self.assertIn('vat (tax)', message)
+            self.assertIn('new_channel_tax (tax) of rate 5', message)
+
+            # Changes of mappings are seen by the lookup
+            mapped_tax.rate = Decimal('5')
+            mapped_tax.save()
+            self.assertEqual(
+                new_channel.get_tax('new_channel_tax', Decimal('5')), tax1
+            )
+            with self.assertRaises(UserError):
+                new_channel.get_tax('new_channel_tax', Decimal('8'))
 
     def test_0115_check_processing_of_sale(self):
         """
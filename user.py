@@ -1,9 +1,11 @@
+from trytond.cache import Cache
 from trytond.model import fields
 
 from trytond.pyson import Eval
 from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
 
-__all__ = ['User']
+__all__ = ['User', 'UserGroup']
 __metaclass__ = PoolMeta
 
 
@@ -32,6 +34,10 @@ class User:
         'get_allowed_channels'
     )
 
+    _allowed_channels_cache = Cache(
+        'res_user.get_allowed_channels', context=False
+    )
+
     @classmethod
     def __setup__(cls):
         super(User, cls).__setup__()
@@ -48,9 +54,33 @@ class User:
             status += ' - %s' % (self.current_channel.rec_name)
         return status
 
+    @classmethod
+    def clear_allowed_channels_cache(cls):
+        """
+        Clear the cached allowed channels of users along with the caches of
+        preferences and record rules which are computed from them.
+        """
+        cls._allowed_channels_cache.clear()
+        cls._get_preferences_cache.clear()
+        Pool().get('ir.rule')._domain_get_cache.clear()
+
     def get_allowed_channels(self, name):
         """
         Return allowed channels
+
+        The allowed channels are cached per user until channels, their users
+        or group memberships change.
+        """
+        key = (self.id, Transaction().user)
+        allowed_channels = self._allowed_channels_cache.get(key)
+        if allowed_channels is None:
+            allowed_channels = self._get_allowed_channels()
+            self._allowed_channels_cache.set(key, allowed_channels)
+        return list(allowed_channels[name])
+
+    def _get_allowed_channels(self):
+        """
+        Return a dictionary of the ids of allowed read and create channels
         """
         Channel = Pool().get('sale.channel')
         Group = Pool().get('res.group')
@@ -62,10 +92,35 @@ class User:
 
         if sale_admin.id in User.get_groups():
             # If user is sale_admin allow read and write on all channels
-            return map(int, Channel.search([]))
+            channel_ids = map(int, Channel.search([]))
+            return {
+                'allowed_read_channels': channel_ids,
+                'allowed_create_channels': channel_ids,
+            }
+
+        create_channel_ids = map(int, self.create_channels)
+        return {
+            'allowed_read_channels': list(
+                set(map(int, self.read_channels) + create_channel_ids)
+            ),
+            'allowed_create_channels': create_channel_ids,
+        }
+
+
+class UserGroup:
+    __name__ = 'res.user-res.group'
 
-        if name == 'allowed_read_channels':
-            return set(map(int, self.read_channels + self.create_channels))
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('res.user').clear_allowed_channels_cache()
+        return super(UserGroup, cls).create(vlist)
+
+    @classmethod
+    def write(cls, user_groups, values, *args):
+        Pool().get('res.user').clear_allowed_channels_cache()
+        super(UserGroup, cls).write(user_groups, values, *args)
 
-        elif name == 'allowed_create_channels':
-            return map(int, self.create_channels)
+    @classmethod
+    def delete(cls, user_groups):
+        Pool().get('res.user').clear_allowed_channels_cache()
+        super(UserGroup, cls).delete(user_groups)
@@ -121,9 +121,12 @@ class ExportDataWizard(Wizard):
 
     def transition_export_(self):  # pragma: nocover
         """
+        Queue the export jobs for the channel.
+
         Downstream channel implementation can customize the wizard
         """
         Channel = Pool().get('sale.channel')
+        Job = Pool().get('sale.channel.job')
 
         channel = Channel(Transaction().context.get('active_id'))
 
@@ -135,42 +138,20 @@ class ExportDataWizard(Wizard):
                 "Atleast one checkbox need to be ticked"
             )
 
-        message = '\n\nData Has Been Exported Successfully To %s \n\n' % (
-            channel.source
-        )
-
-        orders = []
-        products = []
-        products_with_prices = []
-        products_with_inventory = []
+        jobs = []
         if self.start.export_order_status:
-            orders = channel.export_order_status()
+            jobs.append(Job.enqueue(channel, 'export_order_status'))
 
         if self.start.export_product_prices:
-            products_with_prices = channel.export_product_prices()
+            jobs.append(Job.enqueue(channel, 'export_product_prices'))
 
         if self.start.export_inventory:
-            products_with_inventory = channel.export_inventory()
-
-        if orders and isinstance(orders, list):
-            message += 'Order Status Has Been Exported For Orders : %d \n\n' % (
-                len(orders)
-            )
-
-        if products and isinstance(products, list):
-            message += 'Number of Products Exported : %d \n\n' % len(products)
-
-        if products_with_prices and isinstance(products_with_prices, list):
-            message += 'Prices Has Been Exported For Products : %d \n\n' % (
-                len(products_with_prices)
-            )
+            jobs.append(Job.enqueue(channel, 'export_inventory'))
 
-        if products_with_inventory and isinstance(
-            products_with_inventory, list
-        ):
-            message += 'Inventory Has Been Exported For Products : %d \n\n' % (
-                len(products_with_inventory)
-            )
+        message = '\n\nData Export To %s Has Been Queued \n\n' % (
+            channel.source
+        )
+        message += Job.get_jobs_message(jobs)
 
         self.success.message = message
         return 'success'
@@ -373,32 +354,31 @@ class ImportDataWizard(Wizard):
             }])
         return 'import_'
 
-    def transition_import_(self):  # pragma: nocover
+    def transition_import_(self):
         """
+        Queue the import jobs for the channel.
+
         Downstream channel implementation can customize the wizard
         """
         Channel = Pool().get('sale.channel')
+        Job = Pool().get('sale.channel.job')
 
         channel = Channel(Transaction().context.get('active_id'))
 
-        sales = []
-        products = []
-        message = '\n\nData has been imported succesfully ! \n \n'
-
+        jobs = []
         if self.start.import_orders:
-            sales = channel.import_orders()
+            jobs.append(Job.enqueue(channel, 'import_orders'))
 
         if self.start.import_products == 'all':
-            products = channel.import_products()
+            jobs.append(Job.enqueue(channel, 'import_products'))
 
         if self.start.import_products == 'specific_product':
-            products = channel.import_product(self.start.product_identifier)
-
-        if products and isinstance(products, list):
-            message += 'Number of Products Imported : %d \n\n' % len(products)
+            jobs.append(Job.enqueue(
+                channel, 'import_product', self.start.product_identifier
+            ))
 
-        if sales and isinstance(sales, list):
-            message += 'Number of Sale Orders Imported : %d \n\n' % len(sales)
+        message = '\n\nData import has been queued ! \n\n'
+        message += Job.get_jobs_message(jobs)
 
         self.success.message = message
         return 'success'